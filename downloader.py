@@ -5,12 +5,163 @@ from pathlib import Path
 import importlib.util
 import traceback
 from getpass import getpass
+import time
+from urllib.parse import urlparse
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from sqlalchemy import Column, Integer, Text, UniqueConstraint
+from sqlalchemy.ext.declarative import declarative_base
 
 import hoordu
-from hoordu.models import Source, Subscription
+from hoordu.models import Source, Subscription, RemotePost, File, Related
 from hoordu.plugins import FetchDirection
 from hoordu.forms import *
 
+class RateLimiter:
+    """
+    Token bucket rate limiter keyed by host, shared by every plugin.
+    
+    `limits` maps a host to a `(rate, burst)` tuple, where `rate` is the number
+    of requests per second and `burst` how many requests can be made back to
+    back. The '*' entry applies to every host that isn't listed, hosts
+    without a limit are never throttled.
+    """
+    
+    def __init__(self, limits=None):
+        self.limits = {}
+        self._buckets = {}
+        self._lock = threading.Lock()
+        
+        if limits is not None:
+            self.update(limits)
+    
+    def update(self, limits):
+        with self._lock:
+            for host, limit in limits.items():
+                self.limits[host] = limit
+                self._buckets.pop(host, None)
+    
+    def wait(self, url):
+        """
+        Blocks until a request to the host of `url` is allowed.
+        """
+        
+        host = urlparse(url).hostname if '//' in url else url
+        
+        while True:
+            with self._lock:
+                limit = self.limits.get(host, self.limits.get('*'))
+                if limit is None:
+                    return
+                
+                rate, burst = limit
+                now = time.monotonic()
+                tokens, last = self._buckets.get(host, (burst, now))
+                tokens = min(burst, tokens + (now - last) * rate)
+                
+                if tokens >= 1:
+                    self._buckets[host] = (tokens - 1, now)
+                    return
+                
+                self._buckets[host] = (tokens, now)
+                delay = (1 - tokens) / rate
+            
+            time.sleep(delay)
+
+rate_limiter = RateLimiter()
+
+# how many posts are downloaded with each call to a plugin's `download_many`
+BULK_BATCH_SIZE = 100
+
+# a download job is given up on after failing this many times
+DOWNLOAD_MAX_ATTEMPTS = 5
+
+# set with --queue, plugins add their files to the download queue instead of downloading them
+queue_downloads = False
+
+JobBase = declarative_base()
+
+class DownloadJob(JobBase):
+    """
+    A file that still has to be downloaded, `kind` is either 'orig' or 'thumb'.
+    """
+    
+    __tablename__ = 'download_job'
+    __table_args__ = (UniqueConstraint('file_id', 'kind'),)
+    
+    id = Column(Integer, primary_key=True)
+    source_id = Column(Integer, nullable=False, index=True)
+    file_id = Column(Integer, nullable=False)
+    kind = Column(Text, nullable=False)
+    url = Column(Text, nullable=False)
+    filename = Column(Text)
+    attempts = Column(Integer, nullable=False, default=0)
+    error = Column(Text)
+
+class DownloadQueue:
+    """
+    File downloads stored as jobs in the database.
+    
+    A plugin with a queue adds its files to it in the same transaction as
+    the posts they belong to, so a crash never loses track of a file, and
+    any number of `download-worker` processes can drain it at the same time.
+    """
+    
+    def __init__(self, session):
+        self.session = session
+        DownloadJob.__table__.create(bind=session.get_bind(), checkfirst=True)
+    
+    def put(self, source_id, jobs):
+        """
+        Adds a job for every `(file, kind, url, filename)` tuple in `jobs`,
+        unless the file already has a job of the same kind.
+        """
+        
+        if len(jobs) == 0:
+            return
+        
+        file_ids = {file.id for file, kind, url, filename in jobs}
+        existing = self.session.query(DownloadJob.file_id, DownloadJob.kind).filter(DownloadJob.file_id.in_(file_ids))
+        existing = {(file_id, kind) for file_id, kind in existing}
+        
+        for file, kind, url, filename in jobs:
+            if (file.id, kind) in existing:
+                continue
+            
+            existing.add((file.id, kind))
+            self.session.add(DownloadJob(
+                source_id=source_id,
+                file_id=file.id,
+                kind=kind,
+                url=url,
+                filename=filename,
+                attempts=0
+            ))
+    
+    def take(self, source_id, n, exclude=()):
+        """
+        Claims up to `n` jobs until the end of the transaction, jobs claimed
+        by another worker are skipped instead of waited on.
+        """
+        
+        query = self.session.query(DownloadJob).filter(DownloadJob.source_id == source_id, DownloadJob.attempts < DOWNLOAD_MAX_ATTEMPTS)
+        if len(exclude) > 0:
+            query = query.filter(DownloadJob.id.notin_(exclude))
+        
+        return query.order_by(DownloadJob.attempts, DownloadJob.id).with_for_update(skip_locked=True).limit(n).all()
+
+def discover_plugins(path='.'):
+    """
+    Returns the names of every plugin directory, that is, every `<name>/`
+    with both a `<name>/<name>.py` and a `<name>/<name>.conf` file.
+    """
+    
+    return sorted(
+        d.name for d in Path(path).iterdir()
+        if d.is_dir() and (d / '{}.py'.format(d.name)).is_file() and (d / '{}.conf'.format(d.name)).is_file()
+    )
+
 def load_module(filename):
     module_name = Path(filename).name.split('.')[0]
     spec = importlib.util.spec_from_file_location(module_name, filename)
@@ -20,10 +171,32 @@ def load_module(filename):
 
 def usage():
     print('python3 {0} <plugin> <command> [command arguments]'.format(sys.argv[0]))
+    print('python3 {0} all update-all [--jobs N]'.format(sys.argv[0]))
+    print('python3 {0} all download-list <file> [--jobs N]'.format(sys.argv[0]))
+    print('python3 {0} all repair [--jobs N]'.format(sys.argv[0]))
+    print('python3 {0} all download-worker [--jobs N]'.format(sys.argv[0]))
+    print('')
+    print('with --queue, any command adds the files to the download queue instead of downloading them')
+    print('')
+    print('using \'all\' as the plugin runs the command for every plugin directory at once')
     print('')
     print('available commands:')
-    print('    download <url>')
+    print('    download <url> [--refresh]')
     print('        attempts to download the given url')
+    print('        posts that already have every file are skipped unless --refresh is given')
+    print('')
+    print('    download-list <file> [--jobs N] [--refresh]')
+    print('        downloads every url in the given file, one per line, or stdin if the file is -')
+    print('        with \'all\', each url is downloaded by whichever plugin supports it')
+    print('        with --jobs, N posts of each plugin are downloaded at the same time')
+    print('')
+    print('    repair [--jobs N]')
+    print('        downloads every file that is still missing, post by post')
+    print('        it can be stopped at any time and resumed by running it again')
+    print('')
+    print('    download-worker [--jobs N]')
+    print('        downloads every file in the download queue, N at a time')
+    print('        any number of workers can run at the same time')
     print('')
     print('    sub <sub_name> <url>')
     print('        creates a subscription with the given name and feed')
@@ -37,8 +210,10 @@ def usage():
     print('    update <sub_name>')
     print('        gets all new posts for a subscription')
     print('')
-    print('    update-all')
+    print('    update-all [--jobs N]')
     print('        gets all new posts for every subscription')
+    print('        with --jobs, N subscriptions are updated at the same time')
+    print('        plugins with a combined feed (fanbox) update what they can from it first')
     print('')
     print('    fetch <sub_name> <n>')
     print('        gets <n> older posts for a subscription')
@@ -50,6 +225,25 @@ def fail(format, *args, **kwargs):
     print(format.format(*args, **kwargs))
     sys.exit(1)
 
+def pop_option(args, name, default=None):
+    if name not in args:
+        return default
+    
+    i = args.index(name)
+    if i + 1 >= len(args):
+        fail('missing value for option {0}', name)
+    
+    value = args[i + 1]
+    del args[i:i + 2]
+    return value
+
+def pop_flag(args, name):
+    if name not in args:
+        return False
+    
+    args.remove(name)
+    return True
+
 def _cli_form(form):
     form.clear()
     
@@ -113,6 +307,10 @@ def init(hrd, Plugin, parameters=None):
         
         if success:
             plugin.core.commit()
+            plugin.rate_limiter = rate_limiter
+            if queue_downloads:
+                plugin.download_queue = DownloadQueue(plugin.core.session)
+            
             return plugin
         
         elif plugin is not None:
@@ -129,6 +327,533 @@ def init(hrd, Plugin, parameters=None):
             print('something went wrong with the authentication')
             sys.exit(1)
 
+class PluginPool:
+    """
+    Gives every worker thread its own plugin instance, initialized from
+    a separate hoordu instance so that no database or http session is
+    ever shared between threads.
+    
+    An already initialized `plugin` can be passed to be reused by the first
+    thread that asks for one, so a single worker never initializes twice.
+    A thread that is done with its plugin can `release` it for the same reason.
+    """
+    
+    def __init__(self, config, Plugin, parameters=None, plugin=None):
+        self.config = config
+        self.Plugin = Plugin
+        self.parameters = parameters
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._idle = [plugin] if plugin is not None else []
+        self._plugins = [plugin] if plugin is not None else []
+    
+    def get(self):
+        plugin = getattr(self._local, 'plugin', None)
+        if plugin is None:
+            with self._lock:
+                plugin = self._idle.pop() if len(self._idle) > 0 else None
+            
+            if plugin is None:
+                hrd = hoordu.hoordu(self.config)
+                plugin = init(hrd, self.Plugin, self.parameters)
+                with self._lock:
+                    self._plugins.append(plugin)
+            
+            self._local.plugin = plugin
+        
+        return plugin
+    
+    def release(self):
+        """
+        Hands the calling thread's plugin back to the pool, to be reused by
+        the next thread that asks for one, the calling thread must not use
+        it anymore afterwards.
+        """
+        
+        plugin = getattr(self._local, 'plugin', None)
+        if plugin is not None:
+            self._local.plugin = None
+            with self._lock:
+                self._idle.append(plugin)
+    
+    def finish(self):
+        """
+        Finishes the deferred work of every plugin of the pool,
+        it must only be called once the worker threads are done.
+        """
+        
+        for plugin in self._plugins:
+            finish_plugin(plugin)
+
+def finish_plugin(plugin):
+    """
+    Applies whatever a plugin left for later, like the twitter urls
+    that are still being resolved, and commits it.
+    """
+    
+    if not hasattr(plugin, 'resolve_related'):
+        return
+    
+    try:
+        plugin.resolve_related(wait=True)
+        plugin.core.commit()
+        
+    except:
+        plugin.core.rollback()
+        raise
+
+def update_subscription(pool, sub_id):
+    plugin = pool.get()
+    core = plugin.core
+    
+    try:
+        sub = core.session.query(Subscription).filter(Subscription.id == sub_id).one()
+        it = plugin.get_iterator(sub)
+        posts = {remote_post.id for remote_post in it.fetch(direction=FetchDirection.newer, n=None)}
+        core.commit()
+        return len(posts)
+        
+    except:
+        core.rollback()
+        raise
+
+def parallel_update(pool, subs, jobs):
+    """
+    Updates every subscription in `subs` using `jobs` worker threads.
+    
+    A failing subscription is rolled back and reported at the end,
+    it never affects the other subscriptions.
+    """
+    
+    source = pool.Plugin.name
+    total_posts = 0
+    failed = []
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(update_subscription, pool, sub_id): name for sub_id, name in subs}
+        try:
+            for future in as_completed(futures):
+                name = futures[future]
+                try:
+                    count = future.result()
+                    total_posts += count
+                    print('{0}: subscription \'{1}\': {2} new posts'.format(source, name, count))
+                    
+                except Exception as e:
+                    traceback.print_exc()
+                    print('{0}: subscription \'{1}\' ran into an error'.format(source, name))
+                    failed.append((name, e))
+            
+        except KeyboardInterrupt:
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+    
+    print('')
+    print('{0}: updated {1} subscriptions: {2} ok, {3} failed, {4} posts'.format(source, len(subs), len(subs) - len(failed), len(failed), total_posts))
+    for name, e in failed:
+        print('    \'{0}\': {1!r}'.format(name, e))
+    
+    return failed
+
+def feed_update(plugin, subs):
+    """
+    Lets plugins that can update many subscriptions from a single feed
+    (`plugin.update_subscriptions`) do so first.
+    
+    Returns the subscriptions that still have to be updated one by one.
+    """
+    
+    if not hasattr(plugin, 'update_subscriptions') or len(subs) == 0:
+        return subs
+    
+    source = plugin.name
+    core = plugin.core
+    
+    try:
+        subscriptions = core.session.query(Subscription).filter(Subscription.id.in_([sub_id for sub_id, name in subs])).all()
+        counts = plugin.update_subscriptions(subscriptions)
+        core.commit()
+        
+    except KeyboardInterrupt:
+        raise
+        
+    except:
+        traceback.print_exc()
+        core.rollback()
+        print('{0}: feed update ran into an error, updating every subscription on its own'.format(source))
+        return subs
+    
+    for sub_id, name in subs:
+        if sub_id in counts:
+            print('{0}: subscription \'{1}\': {2} new posts'.format(source, name, counts[sub_id]))
+    
+    return [(sub_id, name) for sub_id, name in subs if sub_id not in counts]
+
+def update_source(pool, subs, jobs):
+    subs = feed_update(pool.get(), subs)
+    pool.release()
+    
+    if len(subs) > 0:
+        parallel_update(pool, subs, jobs)
+    
+    pool.finish()
+
+def load_plugin(plugin_name):
+    plugin_config = hoordu.Dynamic.from_module('{0}/{0}.conf'.format(plugin_name))
+    Plugin = load_module('{0}/{0}.py'.format(plugin_name)).Plugin
+    
+    # rate limits are not part of the source config
+    rate_limits = plugin_config.pop('rate_limits', None)
+    if rate_limits is not None:
+        rate_limiter.update(rate_limits)
+    
+    return Plugin, plugin_config
+
+def init_plugins(config, plugin_names):
+    """
+    Initializes every plugin in `plugin_names`.
+    
+    Returns a list of (PluginPool, plugin) where the plugin is the one
+    the pool hands out to the first thread that asks for one.
+    """
+    
+    # initialization can be interactive, so it's done one plugin at a time
+    plugins = []
+    for plugin_name in plugin_names:
+        Plugin, plugin_config = load_plugin(plugin_name)
+        hrd = hoordu.hoordu(config)
+        plugin = init(hrd, Plugin, plugin_config)
+        plugins.append((PluginPool(config, Plugin, plugin_config, plugin=plugin), plugin))
+    
+    return plugins
+
+def update_all_plugins(config, jobs):
+    """
+    Initializes every plugin once and updates all of their subscriptions,
+    each source runs in parallel with the others since they
+    hit different hosts and have independent rate limits.
+    """
+    
+    sources = []
+    for pool, plugin in init_plugins(config, discover_plugins()):
+        core = plugin.core
+        subs = core.session.query(Subscription.id, Subscription.name).filter(Subscription.source_id == plugin.source.id, Subscription.enabled == True).all()
+        core.commit()
+        
+        sources.append((pool, subs))
+    
+    with ThreadPoolExecutor(max_workers=max(len(sources), 1)) as executor:
+        futures = [executor.submit(update_source, pool, subs, jobs) for pool, subs in sources if len(subs) > 0]
+        for future in futures:
+            future.result()
+
+def read_urls(path):
+    """
+    Reads one url per line from the file at `path`, or stdin if `path` is '-'.
+    Empty lines and lines starting with # are skipped.
+    """
+    
+    if path == '-':
+        lines = sys.stdin.readlines()
+    else:
+        with open(path) as f:
+            lines = f.readlines()
+    
+    urls = (line.strip() for line in lines)
+    return [url for url in urls if url and not url.startswith('#')]
+
+def route_urls(plugins, urls):
+    """
+    Finds the plugin that can download each url using their `parse_url`.
+    
+    Returns a list with the post ids of each plugin, without duplicates,
+    and the list of urls no plugin can download.
+    """
+    
+    routed = [{} for plugin in plugins]
+    unsupported = []
+    for url in dict.fromkeys(urls):
+        # a bare id could belong to any of the plugins
+        if url.isdigit() and len(plugins) > 1:
+            unsupported.append(url)
+            continue
+        
+        for ids, plugin in zip(routed, plugins):
+            id = plugin.parse_url(url)
+            if isinstance(id, str):
+                ids.setdefault(id, url)
+                break
+            
+        else:
+            unsupported.append(url)
+    
+    return [list(ids) for ids in routed], unsupported
+
+def download_post(pool, id, refresh=False):
+    plugin = pool.get()
+    core = plugin.core
+    
+    try:
+        plugin.download(id, preview=False, refresh=refresh)
+        core.commit()
+        
+    except:
+        core.rollback()
+        raise
+
+def bulk_download(pool, ids, jobs, refresh=False):
+    """
+    Downloads every post in `ids` using `jobs` worker threads, or in batches
+    of `BULK_BATCH_SIZE` if the plugin has a `download_many` method.
+    
+    A failing post is rolled back and reported at the end,
+    it never affects the other posts.
+    """
+    
+    source = pool.Plugin.name
+    plugin = pool.get()
+    failed = []
+    
+    if hasattr(plugin, 'download_many'):
+        core = plugin.core
+        for i in range(0, len(ids), BULK_BATCH_SIZE):
+            batch = ids[i:i + BULK_BATCH_SIZE]
+            try:
+                remote_posts = plugin.download_many(batch, refresh=refresh)
+                core.commit()
+                
+            except KeyboardInterrupt:
+                raise
+                
+            except Exception as e:
+                traceback.print_exc()
+                core.rollback()
+                failed.extend((id, e) for id in batch)
+                continue
+            
+            failed.extend((id, 'not found') for id in batch if id not in remote_posts)
+            print('{0}: downloaded {1}/{2} posts'.format(source, min(i + BULK_BATCH_SIZE, len(ids)), len(ids)))
+        
+    else:
+        pool.release()
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = {executor.submit(download_post, pool, id, refresh): id for id in ids}
+            try:
+                for done, future in enumerate(as_completed(futures), 1):
+                    id = futures[future]
+                    try:
+                        future.result()
+                        
+                    except Exception as e:
+                        traceback.print_exc()
+                        print('{0}: post \'{1}\' ran into an error'.format(source, id))
+                        failed.append((id, e))
+                    
+                    print('{0}: downloaded {1}/{2} posts'.format(source, done, len(ids)))
+                
+            except KeyboardInterrupt:
+                executor.shutdown(wait=False, cancel_futures=True)
+                raise
+    
+    print('')
+    print('{0}: downloaded {1} posts: {2} ok, {3} failed'.format(source, len(ids), len(ids) - len(failed), len(failed)))
+    for id, e in failed:
+        print('    \'{0}\': {1!r}'.format(id, e))
+    
+    return failed
+
+def download_list(config, plugin_names, path, jobs, refresh=False):
+    """
+    Downloads every url in the file at `path` with whichever of the plugins
+    supports it, each source runs in parallel with the others.
+    """
+    
+    urls = read_urls(path)
+    
+    sources = init_plugins(config, plugin_names)
+    routed, unsupported = route_urls([plugin for pool, plugin in sources], urls)
+    
+    for url in unsupported:
+        print('can\'t download the given url: {0}'.format(url))
+    
+    with ThreadPoolExecutor(max_workers=max(len(sources), 1)) as executor:
+        futures = [executor.submit(bulk_download, pool, ids, jobs, refresh) for (pool, plugin), ids in zip(sources, routed) if len(ids) > 0]
+        for future in futures:
+            future.result()
+
+def repair_post(pool, remote_post_id):
+    plugin = pool.get()
+    core = plugin.core
+    
+    try:
+        remote_post = core.session.query(RemotePost).filter(RemotePost.id == remote_post_id).one()
+        plugin.download(remote_post=remote_post, preview=False)
+        
+        remote_posts = [remote_post] + [related.remote for related in remote_post.related if related.remote is not None]
+        missing = sum(1 for post in remote_posts for file in post.files if not file.present)
+        core.commit()
+        return missing
+        
+    except:
+        core.rollback()
+        raise
+
+def repair_posts(pool, plugin, jobs):
+    """
+    Downloads the missing files of every post of the plugin's source
+    using `jobs` worker threads.
+    
+    Every post is committed on its own and the incomplete posts are looked
+    up again on each run, so an interrupted repair just resumes.
+    
+    Posts that another post links to through a Related entry (e.g. the
+    contents of a fantia post) are downloaded along with that post,
+    so they're repaired through it instead of in a job of their own.
+    """
+    
+    source = pool.Plugin.name
+    core = plugin.core
+    incomplete_ids = [
+        remote_post_id for remote_post_id, in core.session.query(RemotePost.id)
+            .filter(RemotePost.source_id == plugin.source.id, RemotePost.files.any(File.present == False))
+            .order_by(RemotePost.id)
+    ]
+    
+    main_ids = {}
+    for i in range(0, len(incomplete_ids), BULK_BATCH_SIZE):
+        batch = incomplete_ids[i:i + BULK_BATCH_SIZE]
+        main_ids.update(core.session.query(Related.remote_id, Related.related_to_id).filter(Related.remote_id.in_(batch)))
+    core.commit()
+    
+    remote_post_ids = list(dict.fromkeys(main_ids.get(remote_post_id, remote_post_id) for remote_post_id in incomplete_ids))
+    
+    if len(remote_post_ids) == 0:
+        print('{0}: nothing to repair'.format(source))
+        return []
+    
+    print('{0}: repairing {1} posts'.format(source, len(remote_post_ids)))
+    
+    still_missing = 0
+    failed = []
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(repair_post, pool, remote_post_id): remote_post_id for remote_post_id in remote_post_ids}
+        try:
+            for done, future in enumerate(as_completed(futures), 1):
+                remote_post_id = futures[future]
+                try:
+                    still_missing += future.result()
+                    
+                except Exception as e:
+                    traceback.print_exc()
+                    print('{0}: post {1} ran into an error'.format(source, remote_post_id))
+                    failed.append((remote_post_id, e))
+                
+                print('{0}: repaired {1}/{2} posts'.format(source, done, len(remote_post_ids)))
+            
+        except KeyboardInterrupt:
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+    
+    print('')
+    print('{0}: repaired {1} posts: {2} ok, {3} failed, {4} files still missing'.format(source, len(remote_post_ids), len(remote_post_ids) - len(failed), len(failed), still_missing))
+    for remote_post_id, e in failed:
+        print('    {0}: {1!r}'.format(remote_post_id, e))
+    
+    return failed
+
+def repair_plugins(config, plugin_names, jobs):
+    """
+    Repairs every source in `plugin_names` in parallel with the others.
+    """
+    
+    sources = init_plugins(config, plugin_names)
+    with ThreadPoolExecutor(max_workers=max(len(sources), 1)) as executor:
+        futures = [executor.submit(repair_posts, pool, plugin, jobs) for pool, plugin in sources]
+        for future in futures:
+            future.result()
+
+def download_job(plugin, job):
+    if job.filename is not None:
+        return plugin._download_file(job.url, filename=job.filename)
+    else:
+        return plugin._download_file(job.url)
+
+def drain_queue(plugin, workers):
+    """
+    Downloads and imports the queued files of the plugin's source,
+    `workers` at a time, until there's nothing left.
+    
+    Every job is tried once per run, failed jobs are tried again
+    by later runs until they fail `DOWNLOAD_MAX_ATTEMPTS` times.
+    """
+    
+    source = plugin.name
+    core = plugin.core
+    queue = DownloadQueue(core.session)
+    
+    downloaded = 0
+    failed = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while True:
+            try:
+                jobs = queue.take(plugin.source.id, workers, exclude=failed)
+                if len(jobs) == 0:
+                    core.commit()
+                    break
+                
+                files = core.session.query(File).filter(File.id.in_([job.file_id for job in jobs]))
+                files = {file.id: file for file in files}
+                
+                futures = []
+                for job in jobs:
+                    file = files.get(job.file_id)
+                    # the post was deleted or the file was downloaded some other way
+                    if file is None or (file.present if job.kind == 'orig' else file.thumb_present):
+                        core.session.delete(job)
+                        continue
+                    
+                    futures.append((job, file, executor.submit(download_job, plugin, job)))
+                
+                for job, file, future in futures:
+                    try:
+                        path = future.result()
+                        
+                    except Exception as e:
+                        print('{0}: {1} of file {2} failed: {3!r}'.format(source, job.kind, job.file_id, e))
+                        job.attempts += 1
+                        job.error = repr(e)
+                        failed.append(job.id)
+                        continue
+                    
+                    if job.kind == 'orig':
+                        core.import_file(file, orig=path, move=True)
+                    else:
+                        core.import_file(file, thumb=path, move=True)
+                    
+                    core.session.delete(job)
+                    downloaded += 1
+                
+                core.commit()
+                
+            except:
+                core.rollback()
+                raise
+            
+            print('{0}: downloaded {1} files, {2} failed'.format(source, downloaded, len(failed)))
+    
+    print('{0}: download queue is empty, downloaded {1} files, {2} failed'.format(source, downloaded, len(failed)))
+
+def drain_plugins(config, plugin_names, jobs):
+    """
+    Drains the download queue of every source in `plugin_names`,
+    each source in parallel with the others.
+    """
+    
+    sources = init_plugins(config, plugin_names)
+    with ThreadPoolExecutor(max_workers=max(len(sources), 1)) as executor:
+        futures = [executor.submit(drain_queue, plugin, jobs) for pool, plugin in sources]
+        for future in futures:
+            future.result()
+
 def safe_fetch(plugin, it, direction, n):
     posts = {}
     while True:
@@ -175,12 +900,41 @@ if __name__ == '__main__':
     command = sys.argv[2]
     args = sys.argv[3:]
     
+    jobs = int(pop_option(args, '--jobs', 1))
+    refresh = pop_flag(args, '--refresh')
+    queue_downloads = pop_flag(args, '--queue')
+    
     config = hoordu.Dynamic.from_module('hoordu.conf')
-    hrd = hoordu.hoordu(config)
+    rate_limiter.update(config.get('rate_limits', {}))
     
-    plugin_config = hoordu.Dynamic.from_module('{0}/{0}.conf'.format(plugin_name))
-    Plugin = load_module('{0}/{0}.py'.format(plugin_name)).Plugin
+    if command == 'download-list':
+        if len(args) < 1:
+            fail('missing the file to read the urls from')
+        
+        plugin_names = discover_plugins() if plugin_name == 'all' else [plugin_name]
+        download_list(config, plugin_names, args[0], jobs, refresh)
+        sys.exit(0)
+    
+    if command == 'download-worker':
+        plugin_names = discover_plugins() if plugin_name == 'all' else [plugin_name]
+        drain_plugins(config, plugin_names, jobs)
+        sys.exit(0)
     
+    if command == 'repair':
+        plugin_names = discover_plugins() if plugin_name == 'all' else [plugin_name]
+        repair_plugins(config, plugin_names, jobs)
+        sys.exit(0)
+    
+    if plugin_name == 'all':
+        if command != 'update-all':
+            fail('command \'{0}\' can\'t be used with every plugin', command)
+        
+        update_all_plugins(config, jobs)
+        sys.exit(0)
+    
+    hrd = hoordu.hoordu(config)
+    
+    Plugin, plugin_config = load_plugin(plugin_name)
     plugin = init(hrd, Plugin, plugin_config)
     
     core = plugin.core
@@ -192,7 +946,7 @@ if __name__ == '__main__':
             
             id = plugin.parse_url(url)
             if isinstance(id, str):
-                remote_post = plugin.download(id, preview=False)
+                remote_post = plugin.download(id, preview=False, refresh=refresh)
                 core.commit()
                 
                 print('related urls:')
@@ -236,10 +990,25 @@ if __name__ == '__main__':
             else:
                 fail('subscription named \'{0}\' doesn\'t exist', sub_name)
             
+        elif command == 'update-all' and jobs > 1:
+            subs = core.session.query(Subscription.id, Subscription.name).filter(Subscription.source_id == plugin.source.id, Subscription.enabled == True).all()
+            core.commit()
+            
+            subs = feed_update(plugin, subs)
+            
+            pool = PluginPool(config, Plugin, plugin_config, plugin=plugin)
+            parallel_update(pool, subs, jobs)
+            pool.finish()
+            
         elif command == 'update-all':
+            subs = core.session.query(Subscription.id, Subscription.name).filter(Subscription.source_id == plugin.source.id, Subscription.enabled == True).all()
+            core.commit()
+            
+            remaining = set(sub_id for sub_id, name in feed_update(plugin, subs))
+            
             subs = core.session.query(Subscription).filter(Subscription.source_id == plugin.source.id)
             for sub in subs:
-                if sub.enabled:
+                if sub.enabled and sub.id in remaining:
                     try:
                         print('getting all new posts for subscription \'{0}\''.format(sub.name))
                         it = plugin.get_iterator(sub)
@@ -284,6 +1053,8 @@ if __name__ == '__main__':
             core.session.query(Subscription).filter(Subscription.source_id == plugin.source.id, Subscription.name == sub_name).delete()
             core.commit()
         
+        finish_plugin(plugin)
+        
     except SystemExit:
         pass
         
@@ -3,13 +3,16 @@
 import os
 import re
 import json
-from datetime import datetime, timedelta, timezone
+import time
+from datetime import datetime, timezone
 import dateutil.parser
 from tempfile import mkstemp
 import shutil
 from urllib.parse import urlparse, parse_qs
 import itertools
+import collections
 import functools
+from concurrent.futures import ThreadPoolExecutor
 import requests
 
 import hoordu
@@ -29,7 +32,40 @@ CREATOR_REGEXP = [
 
 POST_GET_URL = 'https://api.fanbox.cc/post.info?postId={post_id}'
 CREATOR_POSTS_URL = 'https://api.fanbox.cc/post.listCreator'
-PAGE_LIMIT = 10
+CREATOR_PAGES_URL = 'https://api.fanbox.cc/post.paginateCreator'
+SUPPORTING_POSTS_URL = 'https://api.fanbox.cc/post.listSupporting'
+SUPPORTING_PLANS_URL = 'https://api.fanbox.cc/plan.listSupporting'
+# posts per page, can be raised with `page_limit` in the source config up to PAGE_LIMIT_MAX
+PAGE_LIMIT = 50
+PAGE_LIMIT_MAX = 300
+
+# size of the pages post.paginateCreator splits a creator's history in
+PAGINATE_PAGE_SIZE = 10
+
+# how many files of a single post are downloaded at the same time
+DOWNLOAD_WORKERS = 4
+
+# how many pages of a creator's history are fetched at the same time when backfilling
+# 1 walks the history one page at a time instead
+BACKFILL_WORKERS = 4
+
+# posts are committed in groups of this many posts, or after this many seconds
+# posts with newly imported files are always committed right away
+COMMIT_INTERVAL = 50
+COMMIT_TIMEOUT = 10
+
+class RateLimitedAdapter(requests.adapters.HTTPAdapter):
+    """
+    Throttles every request made through the plugin's http session.
+    """
+    
+    def __init__(self, plugin, **kwargs):
+        super().__init__(**kwargs)
+        self.plugin = plugin
+    
+    def send(self, request, **kwargs):
+        self.plugin._throttle(request.url)
+        return super().send(request, **kwargs)
 
 class CreatorIterator:
     def __init__(self, fanbox, subscription=None, options=None):
@@ -47,41 +83,188 @@ class CreatorIterator:
         self.creator = options.creator
         
         self.first_id = None
+        self.first_datetime = None
         self.head_id = self.state.get('head_id')
+        self.head_datetime = self.state.get('head_datetime')
         self.tail_id = self.state.get('tail_id')
         self.tail_datetime = self.state.get('tail_datetime')
+        
+        self._uncommitted = 0
+        self._last_commit = time.monotonic()
     
     def _save_state(self):
         self.state.head_id = self.head_id
+        self.state.head_datetime = self.head_datetime
         self.state.tail_id = self.tail_id
         self.state.tail_datetime = self.tail_datetime
         if self.subscription is not None:
             self.subscription.state = self.state.to_json()
     
+    def _post_key(self, published_datetime, post_id):
+        # the order the api lists the posts in
+        d = dateutil.parser.parse(published_datetime).replace(tzinfo=None)
+        return (d, int(post_id))
+    
+    def _windows(self):
+        """
+        Splits the creator's history in windows of about `page_limit` posts,
+        returned as (request parameters, key of the newest post it can contain)
+        from newest to oldest.
+        
+        post.paginateCreator lists the url of every page of the creator,
+        but its pages are always `PAGINATE_PAGE_SIZE` posts long, so only
+        every few of them are used as the start of a window.
+        """
+        
+        response = self.http.get(CREATOR_PAGES_URL, params={'creatorId': self.creator})
+        response.raise_for_status()
+        urls = hoordu.Dynamic.from_json(response.text).body
+        
+        step = max(self.fanbox.page_limit // PAGINATE_PAGE_SIZE, 1)
+        
+        windows = []
+        for url in urls[::step]:
+            params = {name: values[0] for name, values in parse_qs(urlparse(url).query).items()}
+            params['limit'] = self.fanbox.page_limit
+            if 'maxId' in params:
+                key = self._post_key(params['maxPublishedDatetime'], params['maxId'])
+            else:
+                key = None
+            
+            windows.append((params, key))
+        
+        return windows
+    
+    def _walk_window(self, params, end=None):
+        """
+        Lists the posts of a window, following nextUrl until the posts reach
+        `end`, the key where the next window starts.
+        
+        Returns the pages of the window.
+        """
+        
+        pages = []
+        url = CREATOR_POSTS_URL
+        while url is not None:
+            response = self.http.get(url, params=params)
+            response.raise_for_status()
+            body = hoordu.Dynamic.from_json(response.text).body
+            items = body['items']
+            
+            posts = items
+            if end is not None:
+                posts = [post for post in items if self._post_key(post.publishedDatetime, post.id) > end]
+            
+            if len(posts) > 0:
+                pages.append(posts)
+            
+            if len(posts) < len(items):
+                break
+            
+            url = body.nextUrl
+            params = None
+        
+        return pages
+    
+    def _backfill_iterator(self, n=None):
+        """
+        Fetches the windows older than the tail concurrently and yields their
+        pages in order.
+        
+        The tail only moves once every window before it was yielded, so a fetch
+        that stops halfway never leaves a hole behind the tail.
+        """
+        
+        windows = self._windows()
+        
+        tail = None
+        if self.tail_id is not None:
+            tail = self._post_key(self.tail_datetime, self.tail_id)
+            
+            # every post of a window is newer than the start of the next one,
+            # so skip everything before the last window that starts above the tail
+            first = 0
+            for i, (params, key) in enumerate(windows):
+                if key is not None and key >= tail:
+                    first = i
+            
+            windows = windows[first:]
+        
+        ends = [key for params, key in windows[1:]] + [None]
+        bounds = iter([(params, end) for (params, key), end in zip(windows, ends)])
+        
+        workers = self.fanbox.backfill_workers
+        total = 0
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = collections.deque()
+            while True:
+                for params, end in itertools.islice(bounds, workers * 2 - len(pending)):
+                    pending.append(executor.submit(self._walk_window, params, end))
+                
+                if not pending:
+                    return
+                
+                for posts in pending.popleft().result():
+                    if tail is not None:
+                        posts = [post for post in posts if self._post_key(post.publishedDatetime, post.id) < tail]
+                    
+                    if len(posts) == 0:
+                        continue
+                    
+                    if self.head_id is None and self.first_id is None:
+                        self.first_id = posts[0].id
+                        self.first_datetime = posts[0].publishedDatetime
+                    
+                    done = False
+                    if n is not None and total + len(posts) >= n:
+                        posts = posts[:n - total]
+                        done = True
+                    
+                    total += len(posts)
+                    
+                    # posts the user has no access to have no body
+                    yield [post for post in posts if post.body is not None]
+                    
+                    last = posts[-1]
+                    self.tail_id = last.id
+                    self.tail_datetime = last.publishedDatetime
+                    
+                    if done:
+                        for future in pending:
+                            future.cancel()
+                        
+                        return
+    
     def _post_iterator(self, direction=FetchDirection.newer, n=None):
+        if direction == FetchDirection.older and self.fanbox.backfill_workers > 1:
+            yield from self._backfill_iterator(n)
+        else:
+            yield from self._page_iterator(direction, n)
+    
+    def _page_iterator(self, direction=FetchDirection.newer, n=None):
         head = (direction == FetchDirection.newer)
         
-        page_size = PAGE_LIMIT if n is None else min(n, PAGE_LIMIT)
+        page_limit = self.fanbox.page_limit
+        page_size = page_limit if n is None else min(n, page_limit)
         min_id = int(self.head_id) if head and self.head_id is not None else None
-        max_id = self.tail_id if not head else None
-        max_datetime = self.tail_datetime if not head else None
         
+        params = {
+            'creatorId': self.creator,
+            'limit': page_size
+        }
+        
+        if not head and self.tail_id is not None:
+            # posts are ordered by date and then by id, so this starts right
+            # after the tail even if other posts have the same timestamp
+            d = dateutil.parser.parse(self.tail_datetime).replace(tzinfo=None)
+            params['maxPublishedDatetime'] = d.strftime('%Y-%m-%d %H:%M:%S')
+            params['maxId'] = int(self.tail_id) - 1
+        
+        url = CREATOR_POSTS_URL
         total = 0
         first_iteration = True
-        while True:
-            params = {
-                'creatorId': self.creator,
-                'limit': page_size
-            }
-            
-            if max_id is not None:
-                params['maxId'] = int(max_id) - 1
-                # very big assumption that no posts have the time timestamp
-                # fanbox would break if that happened as well
-                d = dateutil.parser.parse(max_datetime).replace(tzinfo=None)
-                params['maxPublishedDatetime'] = (d - timedelta(seconds=1)).strftime('%Y-%m-%d %H:%M:%S')
-            
-            response = self.http.get(CREATOR_POSTS_URL, params=params)
+        while url is not None:
+            response = self.http.get(url, params=params)
             response.raise_for_status()
             body = hoordu.Dynamic.from_json(response.text).body
             posts = body['items']
@@ -91,32 +274,54 @@ class CreatorIterator:
             
             if first_iteration and (self.head_id is None or direction == FetchDirection.newer):
                 self.first_id = posts[0].id
+                self.first_datetime = posts[0].publishedDatetime
             
+            page = []
+            done = False
             for post in posts:
-                id = int(post.id)
-                if min_id is not None and id <= min_id:
-                    return
+                if min_id is not None and int(post.id) <= min_id:
+                    done = True
+                    break
                 
-                # posts the user has no access to have no body
-                if post.body is not None:
-                    yield post
-                
-                max_id = id - 1
-                max_datetime = post.publishedDatetime
-                
-                if direction == FetchDirection.older:
-                    self.tail_id = post.id
-                    self.tail_datetime = post.publishedDatetime
+                page.append(post)
                 
                 total += 1
                 if n is not None and total >= n:
-                    return
+                    done = True
+                    break
+            
+            # posts the user has no access to have no body
+            yield [post for post in page if post.body is not None]
+            
+            if len(page) > 0 and direction == FetchDirection.older:
+                last = page[-1]
+                self.tail_id = last.id
+                self.tail_datetime = last.publishedDatetime
             
-            if body.nextUrl is None:
+            if done:
                 return
             
+            # the next page url already has the cursor and the page size
+            url = body.nextUrl
+            params = None
             first_iteration = False
     
+    def _commit(self):
+        """
+        Commits once every `commit_interval` posts, every `commit_timeout`
+        seconds, or right away if any file was imported since the last commit.
+        """
+        
+        plugin = self.fanbox
+        self._uncommitted += 1
+        elapsed = time.monotonic() - self._last_commit
+        
+        if plugin._imported_files > 0 or self._uncommitted >= plugin.commit_interval or elapsed >= plugin.commit_timeout:
+            plugin.core.commit()
+            plugin._imported_files = 0
+            self._uncommitted = 0
+            self._last_commit = time.monotonic()
+    
     def fetch(self, direction=FetchDirection.newer, n=None):
         """
         Try to get at least `n` newer or older posts from this search
@@ -137,21 +342,39 @@ class CreatorIterator:
             else:
                 n = None
         
-        for post in self._post_iterator(direction, n):
-            remote_post = self.fanbox._to_remote_post(post, preview=self.subscription is None)
-            yield remote_post
-            
-            if self.subscription is not None:
-                self.subscription.feed.append(remote_post)
-            
-            # always commit changes
-            # RemotePost, RemoteTag and the subscription feed are simply a cache
-            # the file downloads are more expensive than a call to the database
-            self.fanbox.core.commit()
+        for page in self._post_iterator(direction, n):
+            for remote_post in self._fetch_page(page):
+                yield remote_post
+                
+                # RemotePost, RemoteTag and the subscription feed are simply a cache
+                # so they're committed in groups, but the file downloads are more
+                # expensive than a call to the database and are committed right away
+                self._commit()
+        
+        self._finish()
+    
+    def _fetch_page(self, page):
+        # look up every post of the page at once
+        known_posts = self.fanbox._get_remote_posts([post.id for post in page])
+        
+        # create the whole page before writing it to the database in one go
+        remote_posts = [
+            self.fanbox._to_remote_post(post, preview=self.subscription is None, known_posts=known_posts)
+            for post in page
+        ]
+        self.fanbox._write_pending(commit=True)
         
+        if self.subscription is not None:
+            self.fanbox._add_to_feed(self.subscription, remote_posts)
+        
+        return remote_posts
+    
+    def _finish(self):
         if self.first_id is not None:
             self.head_id = self.first_id
+            self.head_datetime = self.first_datetime
             self.first_id = None
+            self.first_datetime = None
         
         self._save_state()
         if self.subscription is not None:
@@ -208,6 +431,10 @@ class Fanbox:
         self.source = core.source
         self.log = core.logger
         self.session = core.session
+        self.rate_limiter = None
+        self.download_queue = None
+        self._imported_files = 0
+        self._pending_downloads = []
         
         if config is None:
             config = hoordu.Dynamic.from_json(self.source.config)
@@ -215,13 +442,24 @@ class Fanbox:
         self._load_config(config)
         
         self._init_api()
+        
+        self._load_tags()
     
     def _load_config(self, config):
         self.FANBOXSESSID = config.FANBOXSESSID
+        self.download_workers = config.get('download_workers', DOWNLOAD_WORKERS)
+        self.commit_interval = config.get('commit_interval', COMMIT_INTERVAL)
+        self.commit_timeout = config.get('commit_timeout', COMMIT_TIMEOUT)
+        self.page_limit = min(config.get('page_limit', PAGE_LIMIT), PAGE_LIMIT_MAX)
+        self.backfill_workers = config.get('backfill_workers', BACKFILL_WORKERS)
     
     def _init_api(self):
         self.http = requests.Session()
         
+        adapter = RateLimitedAdapter(self)
+        self.http.mount('https://', adapter)
+        self.http.mount('http://', adapter)
+        
         self.http.headers.update({
             'Origin': 'https://www.fanbox.cc',
             'Referer': 'https://www.fanbox.cc/',
@@ -256,12 +494,15 @@ class Fanbox:
                     'creator': match.group('creator')
                 })
         
-        return post_id
+        return None
+    
+    def _throttle(self, url):
+        if self.rate_limiter is not None:
+            self.rate_limiter.wait(url)
     
     def _download_file(self, url, filename=None):
-        # TODO file downloads should be managed by hoordu
-        # so that rate limiting and a download manager can be
-        # implemented easily and in a centralized way
+        # requests go through the shared rate limiter, queued downloads
+        # (--queue) are fetched through here as well by download-worker
         self.log.debug('downloading %s', url)
         
         if filename is not None:
@@ -282,7 +523,152 @@ class Fanbox:
         
         return path
     
-    def _to_remote_post(self, post, remote_post=None, preview=False):
+    def _download_files(self, downloads):
+        """
+        Downloads the originals and thumbnails of a single post concurrently
+        and then imports them in their remote order.
+        
+        `downloads` is a list of `(file, orig_url, thumb_url)` tuples,
+        either url can be None if it doesn't need to be downloaded.
+        """
+        
+        if len(downloads) == 0:
+            return
+        
+        def submit(executor, url):
+            return executor.submit(self._download_file, url) if url is not None else None
+        
+        with ThreadPoolExecutor(max_workers=self.download_workers) as executor:
+            futures = [
+                (file, submit(executor, orig_url), submit(executor, thumb_url))
+                for file, orig_url, thumb_url in downloads
+            ]
+        
+        try:
+            results = [
+                (file, orig.result() if orig is not None else None, thumb.result() if thumb is not None else None)
+                for file, orig, thumb in futures
+            ]
+            
+        except:
+            # don't leave behind the files that did finish downloading
+            for _, orig, thumb in futures:
+                for future in (orig, thumb):
+                    if future is not None and future.exception() is None:
+                        os.remove(future.result())
+            
+            raise
+        
+        for file, orig, thumb in sorted(results, key=lambda r: r[0].remote_order):
+            self.core.import_file(file, orig=orig, thumb=thumb, move=True)
+            self._imported_files += 1
+    
+    def _queue_downloads(self, downloads):
+        if len(downloads) > 0:
+            self._pending_downloads.append(downloads)
+    
+    def _write_pending(self, commit=False):
+        """
+        Writes every RemotePost, File, tag and Related entry created since the
+        last call in a single flush, so they're inserted in batches instead of
+        one at a time, and then downloads the queued files of each post.
+        
+        If commit is True, the files of each post are committed as soon as
+        they're imported, so an interruption never rolls back stored files.
+        
+        If the plugin has a `download_queue`, the files are added to it as
+        jobs instead, to be downloaded later by a separate worker.
+        """
+        
+        self.core.flush()
+        
+        pending, self._pending_downloads = self._pending_downloads, []
+        if self.download_queue is not None:
+            jobs = []
+            for downloads in pending:
+                for file, orig_url, thumb_url in downloads:
+                    if orig_url is not None:
+                        jobs.append((file, 'orig', orig_url, None))
+                    
+                    if thumb_url is not None:
+                        jobs.append((file, 'thumb', thumb_url, None))
+            
+            self.download_queue.put(self.source.id, jobs)
+            return
+        
+        for downloads in pending:
+            self._download_files(downloads)
+            
+            if commit and self._imported_files > 0:
+                self.core.commit()
+                self._imported_files = 0
+    
+    def _add_to_feed(self, subscription, remote_posts):
+        """
+        Adds posts to the feed of a subscription by inserting the association
+        rows directly, so the whole feed never has to be loaded.
+        
+        The posts must have been flushed already.
+        """
+        
+        feed = Subscription.feed.property
+        if feed.secondary is None:
+            for remote_post in remote_posts:
+                subscription.feed.append(remote_post)
+            
+            return
+        
+        (_, subscription_column), = feed.synchronize_pairs
+        (_, post_column), = feed.secondary_synchronize_pairs
+        
+        post_ids = {remote_post.id for remote_post in remote_posts}
+        if len(post_ids) == 0:
+            return
+        
+        existing = self.session.query(post_column).filter(subscription_column == subscription.id, post_column.in_(post_ids))
+        post_ids -= {post_id for post_id, in existing}
+        
+        if len(post_ids) > 0:
+            self.session.execute(feed.secondary.insert(), [
+                {subscription_column.name: subscription.id, post_column.name: post_id}
+                for post_id in post_ids
+            ])
+    
+    def _load_tags(self):
+        tags = self.session.query(RemoteTag).filter(RemoteTag.source_id == self.source.id)
+        self._tags = {(tag.category, tag.tag): tag for tag in tags}
+    
+    def _get_remote_tag(self, category, tagname):
+        """
+        Cached version of `core.get_remote_tag`.
+        """
+        
+        key = (category, tagname)
+        tag = self._tags.get(key)
+        
+        # tags created in a transaction that was rolled back are no longer part of the session
+        if tag is None or tag not in self.session:
+            tag = self.core.get_remote_tag(category, tagname)
+            self._tags[key] = tag
+        
+        return tag
+    
+    def _get_remote_posts(self, original_ids):
+        """
+        Looks up the RemotePosts of this source for every id in `original_ids`
+        with a single query.
+        
+        Returns a dict of original_id -> RemotePost, posts that don't exist
+        yet are left out.
+        """
+        
+        if len(original_ids) == 0:
+            return {}
+        
+        remote_posts = self.session.query(RemotePost).filter(RemotePost.source_id == self.source.id, RemotePost.original_id.in_(original_ids))
+        return {remote_post.original_id: remote_post for remote_post in remote_posts}
+    
+    def _to_remote_post(self, post, remote_post=None, preview=False, known_posts=None):
         main_id = post.id
         creator_id = post.user.userId
         creator_slug = post.creatorId
@@ -293,7 +679,10 @@ class Fanbox:
         self.log.info('getting post %s', main_id)
         
         if remote_post is None:
-            remote_post = self.session.query(RemotePost).filter(RemotePost.source_id == self.source.id, RemotePost.original_id == main_id).one_or_none()
+            if known_posts is not None:
+                remote_post = known_posts.get(main_id)
+            else:
+                remote_post = self.session.query(RemotePost).filter(RemotePost.source_id == self.source.id, RemotePost.original_id == main_id).one_or_none()
             
             if remote_post is None:
                 self.log.info('creating new post')
@@ -316,7 +705,7 @@ class Fanbox:
                     remote_post.favorite = True
                 
                 # creators are identified by their pixiv id because their name and creatorId can change
-                creator_tag = self.core.get_remote_tag(TagCategory.artist, creator_id)
+                creator_tag = self._get_remote_tag(TagCategory.artist, creator_id)
                 remote_post.tags.append(creator_tag)
                 metadata = hoordu.Dynamic.from_json(creator_tag.metadata_)
                 if metadata.get('name', None) != creator_name or metadata.get('slug', None) != creator_slug:
@@ -326,18 +715,22 @@ class Fanbox:
                     self.core.add(creator_tag)
                 
                 for tag in post.tags:
-                    remote_tag = self.core.get_remote_tag(TagCategory.general, tag)
+                    remote_tag = self._get_remote_tag(TagCategory.general, tag)
                     remote_post.tags.append(remote_tag)
                 
                 if post.hasAdultContent is True:
-                    nsfw_tag = self.core.get_remote_tag(TagCategory.meta, 'nsfw')
+                    nsfw_tag = self._get_remote_tag(TagCategory.meta, 'nsfw')
                     remote_post.tags.append(nsfw_tag)
                 
                 self.core.add(remote_post)
+                
+                if known_posts is not None:
+                    known_posts[main_id] = remote_post
         
         if post.type == 'image':
             current_files = {file.metadata_: file for file in remote_post.files}
             
+            downloads = []
             for image, order in zip(post.body.images, itertools.count(1)):
                 id = 'i-{}'.format(image.id)
                 file = current_files.get(id)
@@ -345,8 +738,7 @@ class Fanbox:
                 if file is None:
                     file = File(remote=remote_post, remote_order=order, metadata_=id)
                     self.core.add(file)
-                    self.core.flush()
-                    self.log.info('found new file for post %s, file order: %s', remote_post.id, order)
+                    self.log.info('found new file for post %s, file order: %s', remote_post.original_id, order)
                     
                 else:
                     file.remote_order = order
@@ -356,12 +748,13 @@ class Fanbox:
                 need_thumb = not file.thumb_present
                 
                 if need_thumb or need_orig:
-                    self.log.info('downloading files for post: %s, file: %r, thumb: %r', remote_post.id, need_orig, need_thumb)
-                    
-                    orig = self._download_file(image.originalUrl) if need_orig else None
-                    thumb = self._download_file(image.thumbnailUrl) if need_thumb else None
+                    self.log.info('downloading files for post: %s, file: %r, thumb: %r', remote_post.original_id, need_orig, need_thumb)
                     
-                    self.core.import_file(file, orig=orig, thumb=thumb, move=True)
+                    orig_url = image.originalUrl if need_orig else None
+                    thumb_url = image.thumbnailUrl if need_thumb else None
+                    downloads.append((file, orig_url, thumb_url))
+            
+            self._queue_downloads(downloads)
             
             remote_post.comment = post.body.text
             self.core.add(remote_post)
@@ -369,6 +762,7 @@ class Fanbox:
         elif post.type == 'file':
             current_files = {file.metadata_: file for file in remote_post.files}
             
+            downloads = []
             for rfile, order in zip(post.body.files, itertools.count(1)):
                 id = 'f-{}'.format(rfile.id)
                 file = current_files.get(id)
@@ -377,8 +771,7 @@ class Fanbox:
                     filename = '{0.name}.{0.extension}'.format(rfile)
                     file = File(remote=remote_post, remote_order=order, filename=filename, metadata_=id)
                     self.core.add(file)
-                    self.core.flush()
-                    self.log.info('found new file for post %s, file order: %s', remote_post.id, order)
+                    self.log.info('found new file for post %s, file order: %s', remote_post.original_id, order)
                     
                 else:
                     file.remote_order = order
@@ -388,12 +781,13 @@ class Fanbox:
                 need_thumb = not file.thumb_present and post.coverImageUrl is not None
                 
                 if need_thumb or need_orig:
-                    self.log.info('downloading files for post: %s, file: %r, thumb: %r', remote_post.id, need_orig, need_thumb)
-                    
-                    orig = self._download_file(rfile.url) if need_orig else None
-                    thumb = self._download_file(post.coverImageUrl) if need_thumb else None
+                    self.log.info('downloading files for post: %s, file: %r, thumb: %r', remote_post.original_id, need_orig, need_thumb)
                     
-                    self.core.import_file(file, orig=orig, thumb=thumb, move=True)
+                    orig_url = rfile.url if need_orig else None
+                    thumb_url = post.coverImageUrl if need_thumb else None
+                    downloads.append((file, orig_url, thumb_url))
+            
+            self._queue_downloads(downloads)
             
             remote_post.comment = post.body.text
             self.core.add(remote_post)
@@ -407,6 +801,7 @@ class Fanbox:
             
             order = 1
             
+            downloads = []
             blog = []
             for block in post.body.blocks:
                 if block.type == 'p':
@@ -422,8 +817,7 @@ class Fanbox:
                     if file is None:
                         file = File(remote=remote_post, remote_order=order, metadata_=id)
                         self.core.add(file)
-                        self.core.flush()
-                        self.log.info('found new file for post %s, file order: %s', remote_post.id, order)
+                        self.log.info('found new file for post %s, file order: %s', remote_post.original_id, order)
                         
                     else:
                         file.remote_order = order
@@ -436,12 +830,9 @@ class Fanbox:
                     need_thumb = not file.thumb_present
                     
                     if need_thumb or need_orig:
-                        self.log.info('downloading files for post: %s, order: %r', remote_post.id, file.remote_order)
+                        self.log.info('downloading files for post: %s, order: %r', remote_post.original_id, file.remote_order)
                         
-                        orig = self._download_file(orig_url) if need_orig else None
-                        thumb = self._download_file(thumb_url) if need_thumb else None
-                        
-                        self.core.import_file(file, orig=orig, thumb=thumb, move=True)
+                        downloads.append((file, orig_url if need_orig else None, thumb_url if need_thumb else None))
                     
                     blog.append({
                         'type': 'file',
@@ -457,8 +848,7 @@ class Fanbox:
                     if file is None:
                         file = File(remote=remote_post, remote_order=order, metadata_=id)
                         self.core.add(file)
-                        self.core.flush()
-                        self.log.info('found new file for post %s, file order: %s', remote_post.id, order)
+                        self.log.info('found new file for post %s, file order: %s', remote_post.original_id, order)
                     
                     orig_url = filemap[block.fileId].url
                     thumb_url = post.coverImageUrl
@@ -467,12 +857,9 @@ class Fanbox:
                     need_thumb = not file.thumb_present and thumb_url is not None
                     
                     if need_thumb or need_orig:
-                        self.log.info('downloading files for post: %s, order: %r', remote_post.id, file.remote_order)
-                        
-                        orig = self._download_file(orig_url) if need_orig else None
-                        thumb = self._download_file(thumb_url) if need_thumb else None
+                        self.log.info('downloading files for post: %s, order: %r', remote_post.original_id, file.remote_order)
                         
-                        self.core.import_file(file, orig=orig, thumb=thumb, move=True)
+                        downloads.append((file, orig_url if need_orig else None, thumb_url if need_thumb else None))
                     
                     blog.append({
                         'type': 'file',
@@ -501,6 +888,8 @@ class Fanbox:
                 else:
                     self.log.warning('unknown blog block: %s', str(block.type))
             
+            self._queue_downloads(downloads)
+            
             remote_post.comment = hoordu.Dynamic({'comment': blog}).to_json()
             remote_post.type = PostType.blog
             self.core.add(remote_post)
@@ -515,7 +904,7 @@ class Fanbox:
         
         return remote_post
     
-    def download(self, url=None, remote_post=None, preview=False):
+    def download(self, url=None, remote_post=None, preview=False, refresh=False):
         """
         Creates or updates a RemotePost entry along with all the associated Files,
         and downloads all files and thumbnails that aren't present yet.
@@ -525,6 +914,9 @@ class Fanbox:
         
         If preview is set to True, then only the thumbnails are downloaded.
         
+        Unless refresh is set to True, a post that already has every file
+        present is returned right away without making any request.
+        
         Returns the downloaded RemotePost object.
         """
         
@@ -551,16 +943,34 @@ class Fanbox:
                 if post_id is None:
                     raise ValueError('unsupported url: {}'.format(repr(url)))
         
+        if not refresh:
+            existing = remote_post if remote_post is not None else self._get_remote_posts([post_id]).get(post_id)
+            if existing is not None and self._is_complete(existing, preview):
+                self.log.info('post %s is already complete', post_id)
+                return existing
+        
         response = self.http.get(POST_GET_URL.format(post_id=post_id))
         response.raise_for_status()
         post = hoordu.Dynamic.from_json(response.text).body
         self.log.debug('post json: %s', post)
         
         if post.body is None:
-            self.log.warning('inaccessible post %s', main_id)
+            self.log.warning('inaccessible post %s', post_id)
             return None
         
-        return self._to_remote_post(post, remote_post=remote_post, preview=preview)
+        remote_post = self._to_remote_post(post, remote_post=remote_post, preview=preview)
+        self._write_pending()
+        
+        return remote_post
+    
+    def _is_complete(self, remote_post, preview=False):
+        # attached files ('f-') use the post's cover as their thumbnail,
+        # which not every post has, so once the file is present
+        # it's complete without one
+        return all(
+            (file.thumb_present or (file.present and (file.metadata_ or '').startswith('f-'))) and (preview or file.present)
+            for file in remote_post.files
+        )
     
     def search_form(self):
         return Form('{} search'.format(self.name),
@@ -614,6 +1024,97 @@ class Fanbox:
         """
         
         return CreatorIterator(self, subscription=subscription)
+    
+    def update_subscriptions(self, subscriptions):
+        """
+        Updates many subscriptions at once from the combined feed of every
+        supported creator, which costs a few requests in total instead of
+        at least one per creator.
+        
+        Returns a dict of subscription id -> number of new posts for the
+        subscriptions that were updated, any other subscription still has
+        to be updated on its own.
+        """
+        
+        response = self.http.get(SUPPORTING_PLANS_URL)
+        response.raise_for_status()
+        supported = set(plan.creatorId for plan in hoordu.Dynamic.from_json(response.text).body)
+        
+        # the feed is ordered by date, so a creator is only covered once
+        # the date of its newest known post is known
+        iterators = {}
+        for subscription in subscriptions:
+            it = self.get_iterator(subscription)
+            if it.creator in supported and it.head_id is not None and it.head_datetime is not None:
+                iterators[it.creator] = it
+        
+        if len(iterators) == 0:
+            return {}
+        
+        counts = {it.subscription.id: 0 for it in iterators.values()}
+        pending = dict(iterators)
+        
+        url = SUPPORTING_POSTS_URL
+        params = {'limit': self.page_limit}
+        pages_read = 0
+        # a creator that hasn't posted in a long time would otherwise make
+        # every update walk back through everyone's posts since then,
+        # once the feed has cost as many pages as there are creators left
+        # they're cheaper to update on their own
+        while url is not None and pages_read < len(pending):
+            pages_read += 1
+            response = self.http.get(url, params=params)
+            response.raise_for_status()
+            body = hoordu.Dynamic.from_json(response.text).body
+            posts = body['items']
+            
+            if len(posts) == 0:
+                break
+            
+            pages = {}
+            for post in posts:
+                it = pending.get(post.creatorId)
+                if it is None:
+                    continue
+                
+                if int(post.id) <= int(it.head_id):
+                    del pending[post.creatorId]
+                    continue
+                
+                if it.first_id is None:
+                    it.first_id = post.id
+                    it.first_datetime = post.publishedDatetime
+                
+                # posts the user has no access to have no body
+                if post.body is not None:
+                    pages.setdefault(post.creatorId, []).append(post)
+            
+            # anything further down the feed is older than these heads
+            oldest = dateutil.parser.parse(posts[-1].publishedDatetime)
+            for creator, it in list(pending.items()):
+                if oldest < dateutil.parser.parse(it.head_datetime):
+                    del pending[creator]
+            
+            for creator, page in pages.items():
+                it = iterators[creator]
+                for remote_post in it._fetch_page(page):
+                    counts[it.subscription.id] += 1
+                    it._commit()
+            
+            url = body.nextUrl
+            params = None
+        
+        # the feed ran out or got too long before reaching these heads,
+        # moving them would leave the posts in between behind for good,
+        # so they're updated on their own
+        for creator, it in pending.items():
+            del counts[it.subscription.id]
+        
+        for creator, it in iterators.items():
+            if creator not in pending:
+                it._finish()
+        
+        return counts
 
 Plugin = Fanbox
 
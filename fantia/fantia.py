@@ -3,12 +3,16 @@
 import os
 import re
 import json
+import time
 from datetime import datetime, timezone
 import dateutil.parser
 from tempfile import mkstemp
 import shutil
 from urllib.parse import urlparse
 import functools
+import itertools
+import collections
+from concurrent.futures import ThreadPoolExecutor
 import requests
 
 import hoordu
@@ -23,8 +27,34 @@ FILENAME_REGEXP = re.compile('^[a-z0-9]+-(?P<filename>.+)$')
 
 POST_GET_URL = 'https://fantia.jp/api/v1/posts/{post_id}'
 FANCLUB_GET_URL = 'https://fantia.jp/api/v1/fanclubs/{fanclub_id}'
+FANCLUB_POSTS_URL = 'https://fantia.jp/fanclubs/{fanclub_id}/posts'
+POST_LINK_REGEXP = re.compile('class="link-block" href="\/posts\/(?P<post_id>\d+)"')
 FILE_DOWNLOAD_URL = 'https://fantia.jp{download_uri}'
 
+# how many files of a single post are downloaded at the same time
+DOWNLOAD_WORKERS = 4
+
+# how many post payloads are fetched at the same time when backfilling
+FETCH_WORKERS = 4
+
+# posts are committed in groups of this many posts, or after this many seconds
+# posts with newly imported files are always committed right away
+COMMIT_INTERVAL = 50
+COMMIT_TIMEOUT = 10
+
+class RateLimitedAdapter(requests.adapters.HTTPAdapter):
+    """
+    Throttles every request made through the plugin's http session.
+    """
+    
+    def __init__(self, plugin, **kwargs):
+        super().__init__(**kwargs)
+        self.plugin = plugin
+    
+    def send(self, request, **kwargs):
+        self.plugin._throttle(request.url)
+        return super().send(request, **kwargs)
+
 class CreatorIterator:
     def __init__(self, fantia, subscription=None, options=None):
         self.fantia = fantia
@@ -42,62 +72,319 @@ class CreatorIterator:
         
         self.head_id = self.state.get('head_id')
         self.tail_id = self.state.get('tail_id')
+        
+        # every post seen so far, as post id -> [previous id, next id]
+        # deleted posts are kept with None so they're never looked up again
+        chain = self.state.get('chain') or {}
+        self.chain = {int(post_id): links for post_id, links in chain.items()}
+        
+        # whether the chain covers every post from the head to the tail,
+        # subscriptions that started before the chain existed never do
+        # and every link out of them would look like a gap
+        self.chain_complete = self.state.get('chain_complete', self.head_id is None)
+        
+        # the listing page the tail was last seen on, and the page of every listed id
+        self.tail_page = self.state.get('tail_page')
+        self._pages = {}
+        
+        self._uncommitted = 0
+        self._last_commit = time.monotonic()
     
     def _save_state(self):
         self.state.head_id = self.head_id
         self.state.tail_id = self.tail_id
+        self.state.chain = {str(post_id): links for post_id, links in self.chain.items()}
+        self.state.chain_complete = self.chain_complete
+        self.state.tail_page = self.tail_page
         if self.subscription is not None:
             self.subscription.state = self.state.to_json()
     
-    def _post_iterator(self, direction=FetchDirection.newer, n=None):
-        post_id = self.head_id if direction == FetchDirection.newer else self.tail_id
+    def _index(self, post):
+        previous_post = post.links.previous
+        next_post = post.links.next
+        self.chain[int(post.id)] = [
+            int(previous_post.id) if previous_post is not None else None,
+            int(next_post.id) if next_post is not None else None
+        ]
+    
+    def _gap_post_ids(self):
+        """
+        Returns the ids that known posts link to but were never fetched,
+        except for the post after the head and the one before the tail,
+        which are just the next ones to fetch in each direction.
+        """
+        
+        if not self.chain_complete or self.head_id is None or self.tail_id is None:
+            return []
+        
+        frontier = set()
+        head_links = self.chain.get(int(self.head_id))
+        if head_links is not None:
+            frontier.add(head_links[1])
         
-        if post_id is None:
-            response = self.http.get(FANCLUB_GET_URL.format(fanclub_id=self.creator_id))
-            response.raise_for_status()
-            fanclub = hoordu.Dynamic.from_json(response.text).fanclub
+        tail_links = self.chain.get(int(self.tail_id))
+        if tail_links is not None:
+            frontier.add(tail_links[0])
+        
+        linked = set(
+            post_id
+            for links in self.chain.values() if links is not None
+            for post_id in links if post_id is not None
+        )
+        
+        return sorted(post_id for post_id in linked if post_id not in self.chain and post_id not in frontier)
+    
+    def _listing_page(self, page):
+        response = self.http.get(FANCLUB_POSTS_URL.format(fanclub_id=self.creator_id), params={'page': page})
+        response.raise_for_status()
+        
+        return [int(post_id) for post_id in POST_LINK_REGEXP.findall(response.text)]
+    
+    def _get_fanclub(self):
+        response = self.http.get(FANCLUB_GET_URL.format(fanclub_id=self.creator_id))
+        response.raise_for_status()
+        return hoordu.Dynamic.from_json(response.text).fanclub
+    
+    def _discover_post_ids(self, after=None, page=1):
+        """
+        Enumerates the ids of the fanclub's posts in the order of the listing,
+        from newest to oldest, one listing page at a time.
+        
+        If `after` is given, only the posts listed after it are yielded.
+        The listing is ordered by publication date, which isn't the order of
+        the ids, so the post is found by its position instead, starting
+        the search at `page`.
+        """
+        
+        start = page
+        found = after is None
+        skipped = []
+        while True:
+            post_ids = self._listing_page(page)
+            if not post_ids:
+                # an unexpected page (layout change, login, age check)
+                # would otherwise look like a fanclub without posts
+                if page == 1 and self._get_fanclub().recent_posts:
+                    raise ValueError('no posts found in the listing of fanclub {}'.format(self.creator_id))
+                
+                break
             
-            if not fanclub.recent_posts:
-                return
+            for post_id in post_ids:
+                if found:
+                    self._pages[post_id] = page
+                    yield post_id
+                    
+                elif post_id == after:
+                    found = True
+                    
+                else:
+                    skipped.append((page, post_id))
             
-            post_id = fanclub.recent_posts[0].id
-            self.head_id = post_id
-            self.tail_id = post_id
+            page += 1
+        
+        if found:
+            return
+        
+        # the post can only be listed before the starting page
+        # if posts were deleted since it was last seen
+        listed = []
+        for page in range(1, start):
+            listed.extend((page, post_id) for post_id in self._listing_page(page))
+        
+        listed.extend(skipped)
+        
+        position = next((i for i, (page, post_id) in enumerate(listed) if post_id == after), None)
+        if position is not None:
+            remaining = listed[position + 1:]
             
         else:
-            # TODO the post might have been deleted
-            # there's no issue if we get all the posts from the beginning up until the head
-            # but there's no way to start at the end without going through everything again
-            response = self.http.get(POST_GET_URL.format(post_id=post_id))
-            response.raise_for_status()
-            post = hoordu.Dynamic.from_json(response.text).post
-            
-            next_post = post.links.next if direction == FetchDirection.newer else post.links.previous
-            if next_post is None:
-                return
+            # the post was deleted, the ids are all that's left to go by
+            self.log.warning('post %s is no longer listed, going by the post ids', after)
+            remaining = [(page, post_id) for page, post_id in listed if post_id < after]
+        
+        for page, post_id in remaining:
+            self._pages[post_id] = page
+            yield post_id
+    
+    def _get_live_post(self, post_id):
+        try:
+            return self.fantia._get_post(post_id)
             
-            post_id = next_post.id
+        except requests.HTTPError as e:
+            if e.response is not None and e.response.status_code == 404:
+                return None
+            
+            raise
+    
+    def _fetch_posts(self, post_ids):
+        """
+        Fetches the payloads of `post_ids` concurrently and yields them in order.
+        
+        At most twice `fetch_workers` requests are queued at any time, so
+        the id discovery is only consumed as fast as posts are processed.
+        Posts that were deleted in the meantime are recorded and skipped.
+        """
+        
+        workers = self.fantia.fetch_workers
+        post_ids = iter(post_ids)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = collections.deque()
+            while True:
+                for post_id in itertools.islice(post_ids, workers * 2 - len(pending)):
+                    pending.append((post_id, executor.submit(self._get_live_post, post_id)))
+                
+                if not pending:
+                    return
+                
+                post_id, future = pending.popleft()
+                post = future.result()
+                if post is None:
+                    self.log.warning('post %s was deleted', post_id)
+                    self.chain[int(post_id)] = None
+                    continue
+                
+                self.log.debug('post: %s', post)
+                yield post
+    
+    def _backfill_iterator(self, n=None):
+        if self.tail_id is not None:
+            # start a page early in case a few posts were deleted since
+            page = max((self.tail_page or 1) - 1, 1)
+            post_ids = self._discover_post_ids(after=int(self.tail_id), page=page)
+            
+        else:
+            post_ids = self._discover_post_ids()
+        
+        if n is not None:
+            post_ids = itertools.islice(post_ids, n)
+        
+        for post in self._fetch_posts(post_ids):
+            if self.head_id is None:
+                self.head_id = post.id
+            
+            yield post
+            
+            self.tail_id = post.id
+            self.tail_page = self._pages.get(int(post.id), self.tail_page)
+    
+    def _recent_post_ids(self):
+        """
+        Returns the ids of the posts listed before the head in the fanclub's
+        `recent_posts`, oldest first, or None if the head isn't in it, either
+        because more posts were published since or because it was deleted.
+        
+        `recent_posts` is ordered by publication date like the listing,
+        a post created before the head can still be published after it,
+        so the ids themselves are never compared.
+        """
+        
+        head_id = int(self.head_id)
+        fanclub = self._get_fanclub()
+        
+        recent_ids = [int(post.id) for post in fanclub.recent_posts]
+        if head_id not in recent_ids:
+            return None
+        
+        return list(reversed(recent_ids[:recent_ids.index(head_id)]))
+    
+    def _update_iterator(self, n=None):
+        post_ids = self._recent_post_ids()
+        if post_ids is None:
+            self.log.info('head is not in recent_posts, walking from %s', self.head_id)
+            yield from self._walk_iterator(n)
+            
+        else:
+            if n is not None:
+                post_ids = post_ids[:n]
+            
+            for post in self._fetch_posts(post_ids):
+                yield post
+                
+                self.head_id = post.id
+        
+        if n is None:
+            # posts that are linked from known posts but were never seen,
+            # e.g. hidden from the listing when the backfill went through
+            gap_ids = self._gap_post_ids()
+            if gap_ids:
+                self.log.info('filling %s gaps in the post chain', len(gap_ids))
+                yield from self._fetch_posts(gap_ids)
+    
+    def _post_iterator(self, direction=FetchDirection.newer, n=None):
+        if direction == FetchDirection.older:
+            yield from self._backfill_iterator(n)
+        else:
+            yield from self._update_iterator(n)
+    
+    def _walk_iterator(self, n=None):
+        # if the head was deleted, the known post before it
+        # still links to whatever came after it
+        anchor_id = int(self.head_id)
+        post = self._get_live_post(anchor_id)
+        while post is None:
+            links = self.chain.get(anchor_id)
+            self.chain[anchor_id] = None
+            anchor_id = links[0] if links is not None else None
+            if anchor_id is None:
+                break
+            
+            self.log.warning('anchor post was deleted, walking from %s', anchor_id)
+            post = self._get_live_post(anchor_id)
+        
+        if post is None:
+            # nothing known is left to walk from, but the post listing
+            # still goes from the newest post down to the known ones
+            self.log.warning('no known post left to walk from, using the post listing')
+            head_id = int(self.head_id)
+            post_ids = itertools.takewhile(lambda post_id: post_id != head_id and post_id not in self.chain, self._discover_post_ids())
+            post_ids = list(reversed(list(post_ids)))
+            if n is not None:
+                post_ids = post_ids[:n]
+            
+            for post in self._fetch_posts(post_ids):
+                yield post
+                self.head_id = post.id
+            
+            return
+        
+        self._index(post)
+        next_post = post.links.next
+        if next_post is None:
+            return
+        
+        post_id = next_post.id
         
         it = range(n) if n is not None else iter(int, 1)
         for _ in it:
-            response = self.http.get(POST_GET_URL.format(post_id=post_id))
-            response.raise_for_status()
-            post = hoordu.Dynamic.from_json(response.text).post
+            post = self.fantia._get_post(post_id)
             self.log.debug('post: %s', post)
             
             yield post
             
-            if direction == FetchDirection.newer:
-                self.head_id = post_id
-            elif direction == FetchDirection.older:
-                self.tail_id = post_id
+            self.head_id = post_id
             
-            next_post = post.links.next if direction == FetchDirection.newer else post.links.previous
+            next_post = post.links.next
             if next_post is None:
                 break
             
             post_id = next_post.id
     
+    def _commit(self):
+        """
+        Commits once every `commit_interval` posts, every `commit_timeout`
+        seconds, or right away if any file was imported since the last commit.
+        """
+        
+        plugin = self.fantia
+        self._uncommitted += 1
+        elapsed = time.monotonic() - self._last_commit
+        
+        if plugin._imported_files > 0 or self._uncommitted >= plugin.commit_interval or elapsed >= plugin.commit_timeout:
+            plugin.core.commit()
+            plugin._imported_files = 0
+            self._uncommitted = 0
+            self._last_commit = time.monotonic()
+    
     def fetch(self, direction=FetchDirection.newer, n=None):
         """
         Try to get at least `n` newer or older posts from this search
@@ -113,18 +400,20 @@ class CreatorIterator:
             direction = FetchDirection.older
         
         for post in self._post_iterator(direction, n):
+            self._index(post)
             remote_posts = self.fantia._to_remote_posts(post, preview=self.subscription is None)
+            self.fantia._write_pending(commit=True)
+            
             for remote_post in remote_posts:
                 yield remote_post
             
             if self.subscription is not None:
-                for p in remote_posts:
-                    self.subscription.feed.append(p)
+                self.fantia._add_to_feed(self.subscription, remote_posts)
             
-            # always commit changes
             # RemotePost, RemoteTag and the subscription feed are simply a cache
-            # the file downloads are more expensive than a call to the database
-            self.fantia.core.commit()
+            # so they're committed in groups, but the file downloads are more
+            # expensive than a call to the database and are committed right away
+            self._commit()
         
         self._save_state()
         if self.subscription is not None:
@@ -181,6 +470,10 @@ class Fantia:
         self.source = core.source
         self.log = core.logger
         self.session = core.session
+        self.rate_limiter = None
+        self.download_queue = None
+        self._imported_files = 0
+        self._pending_downloads = []
         
         if config is None:
             config = hoordu.Dynamic.from_json(self.source.config)
@@ -188,13 +481,23 @@ class Fantia:
         self._load_config(config)
         
         self._init_api()
+        
+        self._load_tags()
     
     def _load_config(self, config):
         self.session_id = config.session_id
+        self.download_workers = config.get('download_workers', DOWNLOAD_WORKERS)
+        self.commit_interval = config.get('commit_interval', COMMIT_INTERVAL)
+        self.commit_timeout = config.get('commit_timeout', COMMIT_TIMEOUT)
+        self.fetch_workers = config.get('fetch_workers', FETCH_WORKERS)
     
     def _init_api(self):
         self.http = requests.Session()
         
+        adapter = RateLimitedAdapter(self)
+        self.http.mount('https://', adapter)
+        self.http.mount('http://', adapter)
+        
         self.http.headers.update({
             'Origin': 'https://fantia.jp/',
             'Referer': 'https://fantia.jp/',
@@ -227,12 +530,15 @@ class Fantia:
                 'creator_id': match.group('fanclub_id')
             })
         
-        return post_id
+        return None
+    
+    def _throttle(self, url):
+        if self.rate_limiter is not None:
+            self.rate_limiter.wait(url)
     
     def _download_file(self, url, filename=None):
-        # TODO file downloads should be managed by hoordu
-        # so that rate limiting and a download manager can be
-        # implemented easily and in a centralized way
+        # requests go through the shared rate limiter, queued downloads
+        # (--queue) are fetched through here as well by download-worker
         self.log.debug('downloading %s', url)
         
         if filename is not None:
@@ -253,7 +559,152 @@ class Fantia:
         
         return path
     
-    def _content_to_post(self, post, content, remote_post=None, preview=False):
+    def _download_files(self, downloads):
+        """
+        Downloads the originals and thumbnails of a single post concurrently
+        and then imports them in their remote order.
+        
+        `downloads` is a list of `(file, orig_url, thumb_url)` tuples,
+        either url can be None if it doesn't need to be downloaded.
+        """
+        
+        if len(downloads) == 0:
+            return
+        
+        def submit(executor, url, filename=None):
+            return executor.submit(self._download_file, url, filename=filename) if url is not None else None
+        
+        with ThreadPoolExecutor(max_workers=self.download_workers) as executor:
+            futures = [
+                (file, submit(executor, orig_url, file.filename), submit(executor, thumb_url))
+                for file, orig_url, thumb_url in downloads
+            ]
+        
+        try:
+            results = [
+                (file, orig.result() if orig is not None else None, thumb.result() if thumb is not None else None)
+                for file, orig, thumb in futures
+            ]
+            
+        except:
+            # don't leave behind the files that did finish downloading
+            for _, orig, thumb in futures:
+                for future in (orig, thumb):
+                    if future is not None and future.exception() is None:
+                        os.remove(future.result())
+            
+            raise
+        
+        for file, orig, thumb in sorted(results, key=lambda r: r[0].remote_order):
+            self.core.import_file(file, orig=orig, thumb=thumb, move=True)
+            self._imported_files += 1
+    
+    def _queue_downloads(self, downloads):
+        if len(downloads) > 0:
+            self._pending_downloads.append(downloads)
+    
+    def _write_pending(self, commit=False):
+        """
+        Writes every RemotePost, File, tag and Related entry created since the
+        last call in a single flush, so they're inserted in batches instead of
+        one at a time, and then downloads the queued files of each post.
+        
+        If commit is True, the files of each post are committed as soon as
+        they're imported, so an interruption never rolls back stored files.
+        
+        If the plugin has a `download_queue`, the files are added to it as
+        jobs instead, to be downloaded later by a separate worker.
+        """
+        
+        self.core.flush()
+        
+        pending, self._pending_downloads = self._pending_downloads, []
+        if self.download_queue is not None:
+            jobs = []
+            for downloads in pending:
+                for file, orig_url, thumb_url in downloads:
+                    if orig_url is not None:
+                        jobs.append((file, 'orig', orig_url, file.filename))
+                    
+                    if thumb_url is not None:
+                        jobs.append((file, 'thumb', thumb_url, None))
+            
+            self.download_queue.put(self.source.id, jobs)
+            return
+        
+        for downloads in pending:
+            self._download_files(downloads)
+            
+            if commit and self._imported_files > 0:
+                self.core.commit()
+                self._imported_files = 0
+    
+    def _add_to_feed(self, subscription, remote_posts):
+        """
+        Adds posts to the feed of a subscription by inserting the association
+        rows directly, so the whole feed never has to be loaded.
+        
+        The posts must have been flushed already.
+        """
+        
+        feed = Subscription.feed.property
+        if feed.secondary is None:
+            for remote_post in remote_posts:
+                subscription.feed.append(remote_post)
+            
+            return
+        
+        (_, subscription_column), = feed.synchronize_pairs
+        (_, post_column), = feed.secondary_synchronize_pairs
+        
+        post_ids = {remote_post.id for remote_post in remote_posts}
+        if len(post_ids) == 0:
+            return
+        
+        existing = self.session.query(post_column).filter(subscription_column == subscription.id, post_column.in_(post_ids))
+        post_ids -= {post_id for post_id, in existing}
+        
+        if len(post_ids) > 0:
+            self.session.execute(feed.secondary.insert(), [
+                {subscription_column.name: subscription.id, post_column.name: post_id}
+                for post_id in post_ids
+            ])
+    
+    def _load_tags(self):
+        tags = self.session.query(RemoteTag).filter(RemoteTag.source_id == self.source.id)
+        self._tags = {(tag.category, tag.tag): tag for tag in tags}
+    
+    def _get_remote_tag(self, category, tagname):
+        """
+        Cached version of `core.get_remote_tag`.
+        """
+        
+        key = (category, tagname)
+        tag = self._tags.get(key)
+        
+        # tags created in a transaction that was rolled back are no longer part of the session
+        if tag is None or tag not in self.session:
+            tag = self.core.get_remote_tag(category, tagname)
+            self._tags[key] = tag
+        
+        return tag
+    
+    def _get_remote_posts(self, original_ids):
+        """
+        Looks up the RemotePosts of this source for every id in `original_ids`
+        with a single query.
+        
+        Returns a dict of original_id -> RemotePost, posts that don't exist
+        yet are left out.
+        """
+        
+        if len(original_ids) == 0:
+            return {}
+        
+        remote_posts = self.session.query(RemotePost).filter(RemotePost.source_id == self.source.id, RemotePost.original_id.in_(original_ids))
+        return {remote_post.original_id: remote_post for remote_post in remote_posts}
+    
+    def _content_to_post(self, post, content, remote_post=None, preview=False, known_posts=None):
         content_id = '{post_id}-{content_id}'.format(post_id=post.id, content_id=content.id)
         creator_id = str(post.fanclub.id)
         creator_name = post.fanclub.user.name
@@ -263,7 +714,10 @@ class Fantia:
         self.log.info('getting post %s', content_id)
         
         if remote_post is None:
-            remote_post = self.session.query(RemotePost).filter(RemotePost.source_id == self.source.id, RemotePost.original_id == content_id).one_or_none()
+            if known_posts is not None:
+                remote_post = known_posts.get(content_id)
+            else:
+                remote_post = self.session.query(RemotePost).filter(RemotePost.source_id == self.source.id, RemotePost.original_id == content_id).one_or_none()
             
             if remote_post is None:
                 self.log.info('creating new post')
@@ -287,7 +741,7 @@ class Fantia:
                     remote_post.favorite = True
                 
                 # creators are identified by their id because their name can change
-                creator_tag = self.core.get_remote_tag(TagCategory.artist, creator_id)
+                creator_tag = self._get_remote_tag(TagCategory.artist, creator_id)
                 remote_post.tags.append(creator_tag)
                 metadata = hoordu.Dynamic.from_json(creator_tag.metadata_)
                 if metadata.get('name', None) != creator_name:
@@ -296,11 +750,11 @@ class Fantia:
                     self.core.add(creator_tag)
                 
                 for tag in post.tags:
-                    remote_tag = self.core.get_remote_tag(TagCategory.general, tag.name)
+                    remote_tag = self._get_remote_tag(TagCategory.general, tag.name)
                     remote_post.tags.append(remote_tag)
                 
                 if post.rating == 'adult':
-                    nsfw_tag = self.core.get_remote_tag(TagCategory.meta, 'nsfw')
+                    nsfw_tag = self._get_remote_tag(TagCategory.meta, 'nsfw')
                     remote_post.tags.append(nsfw_tag)
                 
                 self.core.add(remote_post)
@@ -309,8 +763,7 @@ class Fantia:
             if len(remote_post.files) == 0:
                 file = File(remote=remote_post, remote_order=0, filename=content.filename)
                 self.core.add(file)
-                self.core.flush()
-                self.log.info('found new file for post %s, filename: %s', remote_post.id, content.filename)
+                self.log.info('found new file for post %s, filename: %s', remote_post.original_id, content.filename)
             else:
                 file = remote_post.files[0]
             
@@ -318,20 +771,15 @@ class Fantia:
             need_thumb = not file.thumb_present
             if need_orig or need_thumb:
                 self.log.info('downloading: %s, file: %r, thumb: %r', content.filename, need_orig, need_thumb)
-                orig_url = FILE_DOWNLOAD_URL.format(download_uri=content.download_uri)
-                orig = self._download_file(orig_url, filename=content.filename) if need_orig else None
+                orig_url = FILE_DOWNLOAD_URL.format(download_uri=content.download_uri) if need_orig else None
+                thumb_url = post.thumb.medium if need_thumb and post.thumb is not None else None
                 
-                if post.thumb is not None:
-                    thumb = self._download_file(post.thumb.medium) if need_thumb else None
-                    
-                else:
-                    thumb = None
-                
-                self.core.import_file(file, orig=orig, thumb=thumb, move=True)
+                self._queue_downloads([(file, orig_url, thumb_url)])
             
         elif content.category == 'photo_gallery':
             current_files = {file.remote_order: file for file in remote_post.files}
             
+            downloads = []
             for photo in content.post_content_photos:
                 order = int(photo.id)
                 file = current_files.get(order)
@@ -339,19 +787,19 @@ class Fantia:
                 if file is None:
                     file = File(remote=remote_post, remote_order=order)
                     self.core.add(file)
-                    self.core.flush()
-                    self.log.info('found new file for post %s, file order: %s', remote_post.id, order)
+                    self.log.info('found new file for post %s, file order: %s', remote_post.original_id, order)
                 
                 need_orig = not file.present and not preview
                 need_thumb = not file.thumb_present
                 
                 if need_thumb or need_orig:
-                    self.log.info('downloading files for post: %s, order: %r', remote_post.id, file.remote_order)
+                    self.log.info('downloading files for post: %s, order: %r', remote_post.original_id, file.remote_order)
                     
-                    orig = self._download_file(photo.url.original) if need_orig else None
-                    thumb = self._download_file(photo.url.medium) if need_thumb else None
-                    
-                    self.core.import_file(file, orig=orig, thumb=thumb, move=True)
+                    orig_url = photo.url.original if need_orig else None
+                    thumb_url = photo.url.medium if need_thumb else None
+                    downloads.append((file, orig_url, thumb_url))
+            
+            self._queue_downloads(downloads)
             
         elif content.category == 'text':
             # there are no files to save
@@ -362,6 +810,7 @@ class Fantia:
             current_files = {file.remote_order: file for file in remote_post.files}
             
             sections = hoordu.Dynamic.from_json(content.comment).ops
+            downloads = []
             blog = []
             for section in sections:
                 insert = section.insert
@@ -380,8 +829,7 @@ class Fantia:
                         if file is None:
                             file = File(remote=remote_post, remote_order=order)
                             self.core.add(file)
-                            self.core.flush()
-                            self.log.info('found new file for post %s, file order: %s', remote_post.id, order)
+                            self.log.info('found new file for post %s, file order: %s', remote_post.original_id, order)
                         
                         orig_url = FILE_DOWNLOAD_URL.format(download_uri=fantiaImage.original_url)
                         thumb_url = fantiaImage.url
@@ -390,12 +838,9 @@ class Fantia:
                         need_thumb = not file.thumb_present
                         
                         if need_thumb or need_orig:
-                            self.log.info('downloading files for post: %s, order: %r', remote_post.id, file.remote_order)
+                            self.log.info('downloading files for post: %s, order: %r', remote_post.original_id, file.remote_order)
                             
-                            orig = self._download_file(orig_url) if need_orig else None
-                            thumb = self._download_file(thumb_url) if need_thumb else None
-                            
-                            self.core.import_file(file, orig=orig, thumb=thumb, move=True)
+                            downloads.append((file, orig_url if need_orig else None, thumb_url if need_thumb else None))
                         
                         blog.append({
                             'type': 'file',
@@ -405,6 +850,8 @@ class Fantia:
                     else:
                         self.log.warning('unknown blog insert: %s', str(insert))
             
+            self._queue_downloads(downloads)
+            
             remote_post.comment = hoordu.Dynamic({'comment': blog}).to_json()
             remote_post.type = PostType.blog
             self.core.add(remote_post)
@@ -424,7 +871,7 @@ class Fantia:
         self.log.info('getting post %s', main_id)
         
         if remote_post is not None:
-            id_parts = remote_post.id.split('-')
+            id_parts = remote_post.original_id.split('-')
             if len(id_parts) == 2:
                 content_id = int(id_parts[1])
                 
@@ -435,8 +882,12 @@ class Fantia:
                 else:
                     return [remote_post]
         
+        # look up the post and all of its contents at once
+        content_ids = ['{post_id}-{content_id}'.format(post_id=post.id, content_id=content.id) for content in post.post_contents]
+        known_posts = self._get_remote_posts([main_id] + content_ids)
+        
         if remote_post is None:
-            remote_post = self.session.query(RemotePost).filter(RemotePost.source_id == self.source.id, RemotePost.original_id == main_id).one_or_none()
+            remote_post = known_posts.get(main_id)
             
             if remote_post is None:
                 self.log.info('creating new post')
@@ -454,7 +905,7 @@ class Fantia:
                     remote_post.favorite = True
                 
                 # creators are identified by their id because their name can change
-                creator_tag = self.core.get_remote_tag(TagCategory.artist, creator_id)
+                creator_tag = self._get_remote_tag(TagCategory.artist, creator_id)
                 remote_post.tags.append(creator_tag)
                 metadata = hoordu.Dynamic.from_json(creator_tag.metadata_)
                 if metadata.get('name', None) != creator_name:
@@ -463,11 +914,11 @@ class Fantia:
                     self.core.add(creator_tag)
                 
                 for tag in post.tags:
-                    remote_tag = self.core.get_remote_tag(TagCategory.general, tag.name)
+                    remote_tag = self._get_remote_tag(TagCategory.general, tag.name)
                     remote_post.tags.append(remote_tag)
                 
                 if post.rating == 'adult':
-                    nsfw_tag = self.core.get_remote_tag(TagCategory.meta, 'nsfw')
+                    nsfw_tag = self._get_remote_tag(TagCategory.meta, 'nsfw')
                     remote_post.tags.append(nsfw_tag)
                 
                 
@@ -478,7 +929,6 @@ class Fantia:
             if post.thumb is not None:
                 file = File(remote=remote_post, remote_order=0)
                 self.core.add(file)
-                self.core.flush()
             else:
                 file = None
         else:
@@ -488,25 +938,30 @@ class Fantia:
             need_orig = not file.present and not preview
             need_thumb = not file.thumb_present
             if need_orig or need_thumb:
-                self.log.info('downloading files for post: %s, order: %r', remote_post.id, file.remote_order)
-                orig = self._download_file(post.thumb.original) if need_orig else None
-                thumb = self._download_file(post.thumb.medium) if need_thumb else None
-                self.core.import_file(file, orig=orig, thumb=thumb, move=True)
+                self.log.info('downloading files for post: %s, order: %r', remote_post.original_id, file.remote_order)
+                orig_url = post.thumb.original if need_orig else None
+                thumb_url = post.thumb.medium if need_thumb else None
+                self._queue_downloads([(file, orig_url, thumb_url)])
+        
+        # load the existing relations once, new posts can't have any yet
+        if remote_post.id is not None:
+            related_ids = {remote_id for remote_id, in self.session.query(Related.remote_id).filter(Related.related_to_id == remote_post.id)}
+        else:
+            related_ids = set()
         
         # convert the post contents to posts as well
+        # the new relations are inserted together with the rest of the post
         remote_posts = [remote_post]
         for content in post.post_contents:
             if content.visible_status == 'visible':
-                content_post = self._content_to_post(post, content, preview=preview)
+                content_post = self._content_to_post(post, content, preview=preview, known_posts=known_posts)
                 remote_posts.append(content_post)
-                self.core.flush()
-                rel = self.session.query(Related).filter(Related.related_to_id == remote_post.id, Related.remote_id == content_post.id).one_or_none()
-                if rel is None:
+                if content_post.id is None or content_post.id not in related_ids:
                     remote_post.related.append(Related(remote=content_post))
         
         return remote_posts
     
-    def download(self, url=None, remote_post=None, preview=False):
+    def download(self, url=None, remote_post=None, preview=False, refresh=False):
         """
         Creates or updates a RemotePost entry along with all the associated Files,
         and downloads all files and thumbnails that aren't present yet.
@@ -516,6 +971,9 @@ class Fantia:
         
         If preview is set to True, then only the thumbnails are downloaded.
         
+        Unless refresh is set to True, a post that already has every file
+        present is returned right away without making any request.
+        
         Returns the downloaded RemotePost object.
         """
         
@@ -538,17 +996,40 @@ class Fantia:
                 
                 post_id = match.group('post_id')
         
-        response = self.http.get(POST_GET_URL.format(post_id=post_id))
-        response.raise_for_status()
-        post = hoordu.Dynamic.from_json(response.text).post
+        if not refresh:
+            main_post = self._get_remote_posts([post_id]).get(post_id)
+            if main_post is not None:
+                # the contents of a post are posts of their own
+                content_posts = [related.remote for related in main_post.related if related.remote is not None]
+                if all(self._is_complete(post, preview) for post in [main_post] + content_posts):
+                    self.log.info('post %s is already complete', post_id)
+                    return main_post
+        
+        post = self._get_post(post_id)
         self.log.debug('post json: %s', post)
         
         remote_posts = self._to_remote_posts(post, remote_post=remote_post, preview=preview)
+        self._write_pending()
+        
         if remote_posts is not None and len(remote_posts) > 0:
             return remote_posts[0]
         else:
             return None
     
+    def _get_post(self, post_id):
+        response = self.http.get(POST_GET_URL.format(post_id=post_id))
+        response.raise_for_status()
+        return hoordu.Dynamic.from_json(response.text).post
+    
+    def _is_complete(self, remote_post, preview=False):
+        # only file contents have a filename, their thumbnail is the post's
+        # thumbnail, which not every post has, so once the file is present
+        # it's complete without one
+        return all(
+            (file.thumb_present or (file.present and file.filename is not None)) and (preview or file.present)
+            for file in remote_post.files
+        )
+    
     def search_form(self):
         return Form('{} search'.format(self.name),
             ('creator_id', Input('fanclub id', [validators.required()]))
@@ -6,17 +6,35 @@ ORIG_SIZE = 'orig'
 
 PAGE_LIMIT = 200
 
+# how many files of a single post are downloaded at the same time
+DOWNLOAD_WORKERS = 4
+
+# posts are committed in groups of this many posts, or after this many seconds
+# posts with newly imported files are always committed right away
+COMMIT_INTERVAL = 50
+COMMIT_TIMEOUT = 10
+
+# how many short urls are resolved at the same time in the background
+URL_RESOLVER_WORKERS = 8
+
+# resolved short urls are cached for 30 days, up to this many urls
+URL_CACHE_TTL = 30 * 24 * 60 * 60
+URL_CACHE_SIZE = 100000
+
 
 import os
 import re
 import json
+import time
 from datetime import datetime
 from tempfile import mkstemp
 import shutil
 from urllib.parse import urlparse
 import functools
+import threading
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
 import urllib3
-http = urllib3.PoolManager()
 
 import hoordu
 from hoordu.models import *
@@ -24,12 +42,24 @@ from hoordu.plugins import *
 from hoordu.forms import *
 
 from requests_oauthlib import OAuth1Session
+from sqlalchemy import event
 import twitter
 
 OAUTH_REQUEST_TOKEN_URL = 'https://api.twitter.com/oauth/request_token'
 OAUTH_ACCESS_TOKEN_URL = 'https://api.twitter.com/oauth/access_token'
 OAUTH_AUTHORIZATION_URL = 'https://api.twitter.com/oauth/authorize'
 
+USER_TIMELINE_ENDPOINT = 'statuses/user_timeline.json'
+FAVORITES_ENDPOINT = 'favorites/list.json'
+STATUS_ENDPOINT = 'statuses/show.json'
+STATUS_LOOKUP_ENDPOINT = 'statuses/lookup.json'
+
+# how many tweets can be looked up with a single request
+STATUS_LOOKUP_LIMIT = 100
+RATE_LIMIT_EXCEEDED = 88
+
+URL_CACHE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'url_cache.db')
+
 TWEET_FORMAT = 'https://twitter.com/{user}/status/{tweet_id}'
 TWEET_REGEXP = re.compile('^https?:\/\/twitter\.com\/(?P<user>[^\/]+)\/status\/(?P<tweet_id>\d+)(?:\/.*)?(?:\?.*)?$')
 TIMELINE_REGEXP = re.compile('^https?:\/\/twitter\.com\/(?P<user>[^\/]+)(?:\/(?P<type>[^\/]+)?)?(?:\?.*)?$')
@@ -61,22 +91,165 @@ def oauth_finish(consumer_key, consumer_secret, oauth_token, oauth_token_secret,
     
     return access_token_key, access_token_secret
 
-def unwind_url(url):
+class UrlCache:
+    """
+    Persistent cache of the final url each short url redirects to.
+    
+    Entries expire `ttl` seconds after being resolved, and once there are
+    more than `size` entries the least recently used ones are evicted.
+    """
+    
+    def __init__(self, path, ttl=URL_CACHE_TTL, size=URL_CACHE_SIZE):
+        self.ttl = ttl
+        self.size = size
+        self._lock = threading.Lock()
+        self._inserts = 0
+        
+        self._db = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS urls (url TEXT PRIMARY KEY, final_url TEXT NOT NULL, created REAL NOT NULL, used REAL NOT NULL)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS urls_used ON urls (used)')
+        
+        # a single run rarely inserts enough to trigger an eviction,
+        # so expired and excess entries from previous runs are dropped here
+        with self._lock:
+            self._evict(time.time())
+    
+    def get(self, url):
+        now = time.time()
+        with self._lock:
+            row = self._db.execute('SELECT final_url, created FROM urls WHERE url = ?', (url,)).fetchone()
+            if row is None:
+                return None
+            
+            final_url, created = row
+            if created + self.ttl < now:
+                self._db.execute('DELETE FROM urls WHERE url = ?', (url,))
+                return None
+            
+            self._db.execute('UPDATE urls SET used = ? WHERE url = ?', (now, url))
+            return final_url
+    
+    def set(self, url, final_url):
+        now = time.time()
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO urls (url, final_url, created, used) VALUES (?, ?, ?, ?)', (url, final_url, now, now))
+            
+            self._inserts += 1
+            if self._inserts % 100 == 0:
+                count, = self._db.execute('SELECT COUNT(*) FROM urls').fetchone()
+                if count > self.size:
+                    self._evict(now)
+    
+    def _evict(self, now):
+        self._db.execute('DELETE FROM urls WHERE created < ?', (now - self.ttl,))
+        self._db.execute('DELETE FROM urls WHERE url IN (SELECT url FROM urls ORDER BY used DESC LIMIT -1 OFFSET ?)', (self.size,))
+
+def unwind_url(http, url, rate_limiter=None, cache=None):
+    if cache is not None:
+        final_url = cache.get(url)
+        if final_url is not None:
+            return final_url
+    
+    short_url = url
     final_url = url
     try:
         while url is not None:
+            if rate_limiter is not None:
+                rate_limiter.wait(url)
+            
             resp = http.request('HEAD', url, redirect=False, timeout=10)
-            if resp.status // 100 == 3:
+            status = resp.status
+            if status // 100 == 3:
                 url = resp.headers.get('Location')
                 if url is not None:
                     final_url = url
             else:
                 url = None
+        
+        # only cache urls whose last hop gave a definitive answer,
+        # throttled or failing redirectors are tried again next time
+        if cache is not None and status != 429 and status // 100 in (2, 4):
+            cache.set(short_url, final_url)
+        
     except:
         pass
     
     return final_url
 
+class ApiPacer:
+    """
+    Spreads the calls to each api endpoint evenly over what's left of its
+    rate limit window.
+    
+    Every plugin instance uses the same credentials and so the same quota,
+    which is why a single pacer is shared by all of them. Each `twitter.Api`
+    only knows the limits from its own responses, so the pacer keeps the
+    remaining calls and the reset time of each endpoint itself, updated
+    after every call from whichever instance made it.
+    """
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._next = {}
+        self._limits = {}
+    
+    def wait(self, endpoint):
+        with self._lock:
+            now = time.time()
+            next_call = max(now, self._next.get(endpoint, now))
+            limit = self._limits.get(endpoint)
+            
+            if limit is None or limit[1] <= now:
+                # the window is unknown or already over
+                interval = 0
+                
+            elif limit[0] <= 0:
+                next_call = max(next_call, limit[1] + 1)
+                interval = 0
+                
+            else:
+                interval = (limit[1] - now) / limit[0]
+                # count this call until its response says otherwise
+                limit[0] -= 1
+            
+            self._next[endpoint] = next_call + interval
+        
+        delay = next_call - now
+        if delay > 0:
+            time.sleep(delay)
+    
+    def update(self, api, endpoint):
+        """
+        Records the limits `api` got from its last call to `endpoint`.
+        """
+        
+        url = '{}/{}'.format(api.base_url, endpoint)
+        limit = api.CheckRateLimit(url)
+        
+        with self._lock:
+            current = self._limits.get(endpoint)
+            # responses from other threads can arrive out of order,
+            # within the same window the lowest remaining count is the latest
+            if current is None or limit.reset > current[1] or (limit.reset == current[1] and limit.remaining < current[0]):
+                self._limits[endpoint] = [limit.remaining, limit.reset]
+    
+    def reset_delay(self, endpoint):
+        with self._lock:
+            limit = self._limits.get(endpoint)
+            reset = limit[1] if limit is not None else 0
+        
+        return max(reset - time.time(), 0) + 1
+
+pacer = ApiPacer()
+
+def is_rate_limit_error(e):
+    if not isinstance(e.message, list):
+        return False
+    
+    return any(isinstance(error, dict) and error.get('code') == RATE_LIMIT_EXCEEDED for error in e.message)
+
 class TweetIterator:
     def __init__(self, twitter, subscription=None, options=None):
         self.twitter = twitter
@@ -99,6 +272,9 @@ class TweetIterator:
         self.first_id = None
         self.head_id = self.state.get('head_id')
         self.tail_id = self.state.get('tail_id')
+        
+        self._uncommitted = 0
+        self._last_commit = time.monotonic()
     
     def _save_state(self):
         self.state.head_id = self.head_id
@@ -106,22 +282,24 @@ class TweetIterator:
         if self.subscription is not None:
             self.subscription.state = self.state.to_json()
     
-    def _page_iterator(self, method, limit=None, max_id=None, **kwargs):
+    def _page_iterator(self, method, endpoint, limit=None, max_id=None, **kwargs):
         total = 0
         while True:
-            tweets = method(max_id=max_id, **kwargs)
+            tweets = self.twitter._api_call(endpoint, method, max_id=max_id, **kwargs)
             self.log.debug('method: %s, max_id: %s, kwargs: %s', method.__name__, max_id, kwargs)
             self.log.debug('page: %s', tweets)
             if len(tweets) == 0:
                 return
             
-            for tweet in tweets:
-                yield tweet
-                max_id = tweet.id - 1
-                
-                total += 1
-                if limit is not None and total >= limit:
-                    return
+            if limit is not None:
+                tweets = tweets[:limit - total]
+            
+            yield tweets
+            
+            max_id = tweets[-1].id - 1
+            total += len(tweets)
+            if limit is not None and total >= limit:
+                return
     
     def _feed_iterator(self, direction=FetchDirection.newer, limit=None):
         head = (direction == FetchDirection.newer)
@@ -137,6 +315,7 @@ class TweetIterator:
         if self.method == 'tweets':
             tweets = self._page_iterator(
                 self.api.GetUserTimeline,
+                USER_TIMELINE_ENDPOINT,
                 limit=limit,
                 screen_name=self.user, count=page_size, exclude_replies=False, include_rts=False,
                 max_id=max_id, since_id=since_id
@@ -145,6 +324,7 @@ class TweetIterator:
         elif self.method == 'retweets':
             tweets = self._page_iterator(
                 self.api.GetUserTimeline,
+                USER_TIMELINE_ENDPOINT,
                 limit=limit,
                 screen_name=self.user, count=page_size, exclude_replies=False, include_rts=True,
                 max_id=max_id, since_id=since_id
@@ -153,6 +333,7 @@ class TweetIterator:
         elif self.method == 'likes':
             tweets = self._page_iterator(
                 self.api.GetFavorites,
+                FAVORITES_ENDPOINT,
                 limit=limit,
                 screen_name=self.user, count=page_size,
                 max_id=max_id, since_id=since_id
@@ -175,6 +356,22 @@ class TweetIterator:
             len(tweet.urls) > 0
         ))
     
+    def _commit(self):
+        """
+        Commits once every `commit_interval` posts, every `commit_timeout`
+        seconds, or right away if any file was imported since the last commit.
+        """
+        
+        plugin = self.twitter
+        self._uncommitted += 1
+        elapsed = time.monotonic() - self._last_commit
+        
+        if plugin._imported_files > 0 or self._uncommitted >= plugin.commit_interval or elapsed >= plugin.commit_timeout:
+            plugin.core.commit()
+            plugin._imported_files = 0
+            self._uncommitted = 0
+            self._last_commit = time.monotonic()
+    
     def fetch(self, direction=FetchDirection.newer, n=None):
         """
         Try to get at least `n` newer or older posts from this search
@@ -193,30 +390,50 @@ class TweetIterator:
             else:
                 limit = None
         
-        tweets = self._feed_iterator(direction, limit=limit)
+        pages = self._feed_iterator(direction, limit=limit)
         
-        posts = []
         first_iteration = True
-        for tweet in tweets:
+        for page in pages:
             if first_iteration and (self.head_id is None or direction == FetchDirection.newer):
-                self.first_id = tweet.id_str
+                self.first_id = page[0].id_str
+            
+            first_iteration = False
             
-            if self._tweet_has_content(tweet):
-                remote_post = self.twitter.tweet_to_remote_post(tweet, preview=self.subscription is None)
+            tweets = [tweet for tweet in page if self._tweet_has_content(tweet)]
+            
+            # look up every post of the page at once
+            known_posts = self.twitter._get_remote_posts([
+                (tweet.retweeted_status if tweet.retweeted_status is not None else tweet).id_str
+                for tweet in tweets
+            ])
+            
+            # create the whole page before writing it to the database in one go
+            remote_posts = [
+                self.twitter.tweet_to_remote_post(tweet, preview=self.subscription is None, known_posts=known_posts)
+                for tweet in tweets
+            ]
+            self.twitter._write_pending(commit=True)
+            
+            if self.subscription is not None:
+                self.twitter._add_to_feed(self.subscription, remote_posts)
+            
+            for remote_post in remote_posts:
                 yield remote_post
                 
-                if self.subscription is not None:
-                    self.subscription.feed.append(remote_post)
-            
-                # always commit changes
+                # apply whatever urls were resolved in the meantime
+                self.twitter.resolve_related()
+                
                 # RemotePost, RemoteTag and the subscription feed are simply a cache
-                # the file downloads are more expensive than a call to the database
-                self.twitter.core.commit()
+                # so they're committed in groups, but the file downloads are more
+                # expensive than a call to the database and are committed right away
+                self._commit()
             
             if direction == FetchDirection.older:
-                self.tail_id = tweet.id_str
-            
-            first_iteration = False
+                self.tail_id = page[-1].id_str
+        
+        # urls that are still resolving stay pending and are applied before
+        # later commits, the process waits for them only once it's done
+        self.twitter.resolve_related()
         
         if self.first_id is not None:
             self.head_id = self.first_id
@@ -316,6 +533,18 @@ class Twitter:
         self.source = core.source
         self.log = core.logger
         self.session = core.session
+        self.rate_limiter = None
+        self.download_queue = None
+        self._imported_files = 0
+        self._pending_downloads = []
+        self._resolver = None
+        self._pending_related = []
+        self._applied_related = []
+        
+        # resolved urls are only final once they're committed,
+        # a rollback puts them back in line to be applied again
+        event.listen(self.session, 'after_commit', self._related_committed)
+        event.listen(self.session, 'after_rollback', self._related_rolled_back)
         
         if config is None:
             config = hoordu.Dynamic.from_json(self.source.config)
@@ -323,6 +552,8 @@ class Twitter:
         self._load_config(config)
         
         self._init_api()
+        
+        self._load_tags()
     
     def _load_config(self, config):
         self.consumer_key = config.consumer_key
@@ -330,16 +561,54 @@ class Twitter:
         
         self.access_token_key = config.get('access_token_key', None)
         self.access_token_secret = config.get('access_token_secret', None)
+        
+        self.download_workers = config.get('download_workers', DOWNLOAD_WORKERS)
+        self.commit_interval = config.get('commit_interval', COMMIT_INTERVAL)
+        self.commit_timeout = config.get('commit_timeout', COMMIT_TIMEOUT)
+        self.url_cache = UrlCache(config.get('url_cache', URL_CACHE_FILE))
+        self.url_resolver_workers = config.get('url_resolver_workers', URL_RESOLVER_WORKERS)
     
     def _init_api(self):
+        # every plugin instance gets its own connections, downloads and
+        # url resolvers mostly go to different hosts, so each host needs
+        # at most as many connections as the larger of the two pools
+        self.http = urllib3.PoolManager(maxsize=max(self.download_workers, self.url_resolver_workers))
+        
         self.api = twitter.Api(
             consumer_key=self.consumer_key,
             consumer_secret=self.consumer_secret,
             access_token_key=self.access_token_key,
             access_token_secret=self.access_token_secret,
-            tweet_mode='extended'
+            tweet_mode='extended',
+            sleep_on_rate_limit=True
         )
     
+    def _api_call(self, endpoint, method, *args, **kwargs):
+        """
+        Calls an api method, pacing it according to the rate limits of the
+        endpoint and waiting for the window to reset if the limit is hit anyway.
+        """
+        
+        while True:
+            self._throttle(self.api.base_url)
+            pacer.wait(endpoint)
+            
+            try:
+                result = method(*args, **kwargs)
+                
+            except twitter.TwitterError as e:
+                if not is_rate_limit_error(e):
+                    raise
+                
+                pacer.update(self.api, endpoint)
+                delay = pacer.reset_delay(endpoint)
+                self.log.info('rate limit exceeded for %s, waiting %d seconds', endpoint, delay)
+                time.sleep(delay)
+                continue
+            
+            pacer.update(self.api, endpoint)
+            return result
+    
     def parse_url(self, url):
         """
         Checks if an url can be downloaded by this plugin.
@@ -372,11 +641,15 @@ class Twitter:
         
         return None
     
+    def _throttle(self, url):
+        if self.rate_limiter is not None:
+            self.rate_limiter.wait(url)
+    
     def _download_file(self, url):
-        # TODO file downloads should be managed by hoordu
-        # so that rate limiting and a download manager can be
-        # implemented easily and in a centralized way
+        # requests go through the shared rate limiter, queued downloads
+        # (--queue) are fetched through here as well by download-worker
         self.log.debug('downloading %s', url)
+        self._throttle(url)
         
         suffix = os.path.splitext(urlparse(url).path)[-1].split(':')[0]
         if not suffix.startswith('.'):
@@ -384,14 +657,14 @@ class Twitter:
         
         fd, path = mkstemp(suffix=suffix)
         
-        with http.request('GET', url, preload_content=False) as resp, \
+        with self.http.request('GET', url, preload_content=False) as resp, \
                 os.fdopen(fd, 'w+b') as file:
             resp.read = functools.partial(resp.read, decode_content=True)
             shutil.copyfileobj(resp, file)
         
         return path
     
-    def _download_video(self, media):
+    def _video_url(self, media):
         variants = media.video_info.get('variants', [])
         
         variant = max(
@@ -401,31 +674,221 @@ class Twitter:
         )
         
         if variant is not None:
-            return self._download_file(variant['url'])
+            return variant['url']
         else:
             return None
     
-    def _download_media(self, media, thumbnail=False, file=False):
+    def _media_urls(self, media, thumbnail=False, file=False):
         thumb = None
         orig = None
         
         if media.type == 'photo':
             if thumbnail:
-                thumb = self._download_file('{}:{}'.format(media.media_url, THUMB_SIZE))
+                thumb = '{}:{}'.format(media.media_url, THUMB_SIZE)
             
             if file:
-                orig = self._download_file('{}:{}'.format(media.media_url, ORIG_SIZE))
+                orig = '{}:{}'.format(media.media_url, ORIG_SIZE)
             
         elif media.type == 'video' or media.type == 'animated_gif':
             if thumbnail:
-                thumb = self._download_file('{}:{}'.format(media.media_url, THUMB_SIZE))
+                thumb = '{}:{}'.format(media.media_url, THUMB_SIZE)
             
             if file:
-                orig = self._download_video(media)
+                orig = self._video_url(media)
         
         return thumb, orig
     
-    def tweet_to_remote_post(self, tweet, remote_post=None, preview=False):
+    def _download_files(self, downloads):
+        """
+        Downloads the originals and thumbnails of a single post concurrently
+        and then imports them in their remote order.
+        
+        `downloads` is a list of `(file, orig_url, thumb_url)` tuples,
+        either url can be None if it doesn't need to be downloaded.
+        """
+        
+        if len(downloads) == 0:
+            return
+        
+        def submit(executor, url):
+            return executor.submit(self._download_file, url) if url is not None else None
+        
+        with ThreadPoolExecutor(max_workers=self.download_workers) as executor:
+            futures = [
+                (file, submit(executor, orig_url), submit(executor, thumb_url))
+                for file, orig_url, thumb_url in downloads
+            ]
+        
+        try:
+            results = [
+                (file, orig.result() if orig is not None else None, thumb.result() if thumb is not None else None)
+                for file, orig, thumb in futures
+            ]
+            
+        except:
+            # don't leave behind the files that did finish downloading
+            for _, orig, thumb in futures:
+                for future in (orig, thumb):
+                    if future is not None and future.exception() is None:
+                        os.remove(future.result())
+            
+            raise
+        
+        for file, orig, thumb in sorted(results, key=lambda r: r[0].remote_order):
+            self.core.import_file(file, orig=orig, thumb=thumb, move=True)
+            self._imported_files += 1
+    
+    def _resolve_later(self, related):
+        """
+        Resolves the url of a Related entry in the background,
+        the entry keeps the short url until `resolve_related` is called.
+        """
+        
+        final_url = self.url_cache.get(related.url)
+        if final_url is not None:
+            related.url = final_url
+            return
+        
+        if self._resolver is None:
+            self._resolver = ThreadPoolExecutor(max_workers=self.url_resolver_workers)
+        
+        future = self._resolver.submit(unwind_url, self.http, related.url, rate_limiter=self.rate_limiter, cache=self.url_cache)
+        self._pending_related.append((related, future))
+    
+    def resolve_related(self, wait=False):
+        """
+        Updates the Related entries whose urls finished resolving,
+        or every pending entry if `wait` is True.
+        """
+        
+        pending = []
+        for related, future in self._pending_related:
+            if wait or future.done():
+                # entries that were rolled back are no longer part of the session
+                if related in self.session:
+                    related.url = future.result()
+                    self._applied_related.append((related, future))
+                
+            else:
+                pending.append((related, future))
+        
+        self._pending_related = pending
+    
+    def _related_committed(self, session):
+        self._applied_related = []
+    
+    def _related_rolled_back(self, session):
+        # the rollback reverted the urls of entries committed earlier,
+        # e.g. by another subscription, so they have to be applied again
+        self._pending_related.extend(self._applied_related)
+        self._applied_related = []
+    
+    def _queue_downloads(self, downloads):
+        if len(downloads) > 0:
+            self._pending_downloads.append(downloads)
+    
+    def _write_pending(self, commit=False):
+        """
+        Writes every RemotePost, File, tag and Related entry created since the
+        last call in a single flush, so they're inserted in batches instead of
+        one at a time, and then downloads the queued files of each post.
+        
+        If commit is True, the files of each post are committed as soon as
+        they're imported, so an interruption never rolls back stored files.
+        
+        If the plugin has a `download_queue`, the files are added to it as
+        jobs instead, to be downloaded later by a separate worker.
+        """
+        
+        self.core.flush()
+        
+        pending, self._pending_downloads = self._pending_downloads, []
+        if self.download_queue is not None:
+            jobs = []
+            for downloads in pending:
+                for file, orig_url, thumb_url in downloads:
+                    if orig_url is not None:
+                        jobs.append((file, 'orig', orig_url, None))
+                    
+                    if thumb_url is not None:
+                        jobs.append((file, 'thumb', thumb_url, None))
+            
+            self.download_queue.put(self.source.id, jobs)
+            return
+        
+        for downloads in pending:
+            self._download_files(downloads)
+            
+            if commit and self._imported_files > 0:
+                self.core.commit()
+                self._imported_files = 0
+    
+    def _add_to_feed(self, subscription, remote_posts):
+        """
+        Adds posts to the feed of a subscription by inserting the association
+        rows directly, so the whole feed never has to be loaded.
+        
+        The posts must have been flushed already.
+        """
+        
+        feed = Subscription.feed.property
+        if feed.secondary is None:
+            for remote_post in remote_posts:
+                subscription.feed.append(remote_post)
+            
+            return
+        
+        (_, subscription_column), = feed.synchronize_pairs
+        (_, post_column), = feed.secondary_synchronize_pairs
+        
+        post_ids = {remote_post.id for remote_post in remote_posts}
+        if len(post_ids) == 0:
+            return
+        
+        existing = self.session.query(post_column).filter(subscription_column == subscription.id, post_column.in_(post_ids))
+        post_ids -= {post_id for post_id, in existing}
+        
+        if len(post_ids) > 0:
+            self.session.execute(feed.secondary.insert(), [
+                {subscription_column.name: subscription.id, post_column.name: post_id}
+                for post_id in post_ids
+            ])
+    
+    def _load_tags(self):
+        tags = self.session.query(RemoteTag).filter(RemoteTag.source_id == self.source.id)
+        self._tags = {(tag.category, tag.tag): tag for tag in tags}
+    
+    def _get_remote_tag(self, category, tagname):
+        """
+        Cached version of `core.get_remote_tag`.
+        """
+        
+        key = (category, tagname)
+        tag = self._tags.get(key)
+        
+        # tags created in a transaction that was rolled back are no longer part of the session
+        if tag is None or tag not in self.session:
+            tag = self.core.get_remote_tag(category, tagname)
+            self._tags[key] = tag
+        
+        return tag
+    
+    def _get_remote_posts(self, original_ids):
+        """
+        Looks up the RemotePosts of this source for every id in `original_ids`
+        with a single query.
+        
+        Returns a dict of original_id -> RemotePost, posts that don't exist
+        yet are left out.
+        """
+        
+        if len(original_ids) == 0:
+            return {}
+        
+        remote_posts = self.session.query(RemotePost).filter(RemotePost.source_id == self.source.id, RemotePost.original_id.in_(original_ids))
+        return {remote_post.original_id: remote_post for remote_post in remote_posts}
+    
+    def tweet_to_remote_post(self, tweet, remote_post=None, preview=False, known_posts=None):
         # get the original tweet if this is a retweet
         if tweet.retweeted_status is not None:
             tweet = tweet.retweeted_status
@@ -438,7 +901,11 @@ class Twitter:
         self.log.info('getting tweet %s', original_id)
         
         if remote_post is None:
-            remote_post = self.session.query(RemotePost).filter(RemotePost.source_id == self.source.id, RemotePost.original_id == original_id).one_or_none()
+            if known_posts is not None:
+                remote_post = known_posts.get(original_id)
+            else:
+                remote_post = self.session.query(RemotePost).filter(RemotePost.source_id == self.source.id, RemotePost.original_id == original_id).one_or_none()
+            
             if remote_post is None:
                 self.log.info('creating new post')
                 remote_post = RemotePost(
@@ -451,20 +918,20 @@ class Twitter:
                     metadata_=json.dumps({'user': user})
                 )
                 
-                user_tag = self.core.get_remote_tag(TagCategory.artist, user)
+                user_tag = self._get_remote_tag(TagCategory.artist, user)
                 remote_post.tags.append(user_tag)
                 
                 if tweet.favorited is True:
                     remote_post.favorite = True
                 
                 if tweet.possibly_sensitive:
-                    nsfw_tag = self.core.get_remote_tag(TagCategory.meta, 'nsfw')
+                    nsfw_tag = self._get_remote_tag(TagCategory.meta, 'nsfw')
                     remote_post.tags.append(nsfw_tag)
                 
                 if tweet.hashtags is not None:
                     for hashtag in tweet.hashtags:
                         tag = hashtag.text
-                        nsfw_tag = self.core.get_remote_tag(TagCategory.general, tag)
+                        nsfw_tag = self._get_remote_tag(TagCategory.general, tag)
                         remote_post.tags.append(nsfw_tag)
                 
                 if tweet.in_reply_to_status_id is not None:
@@ -475,11 +942,15 @@ class Twitter:
                     for url in tweet.urls:
                         # the unwound section is a premium feature
                         self.log.info('found url %s', url.url)
-                        final_url = unwind_url(url.url)
-                        remote_post.related.append(Related(url=final_url))
+                        related = Related(url=url.url)
+                        remote_post.related.append(related)
+                        self._resolve_later(related)
                 
                 self.core.add(remote_post)
                 
+                if known_posts is not None:
+                    known_posts[original_id] = remote_post
+                
             else:
                 self.log.info('post already exists: %s', remote_post.id)
         
@@ -490,21 +961,23 @@ class Twitter:
             for order in available - present:
                 file = File(remote=remote_post, remote_order=order)
                 self.core.add(file)
-                self.core.flush()
-                self.log.info('found new file for post %s, file order: %s', remote_post.id, order)
+                self.log.info('found new file for post %s, file order: %s', remote_post.original_id, order)
             
+            downloads = []
             for file in remote_post.files:
                 need_thumb = not file.thumb_present
                 need_file = not file.present and not preview
                 
                 if need_thumb or need_file:
-                    self.log.info('downloading files for post: %s, order: %r', remote_post.id, file.remote_order)
-                    thumb, orig = self._download_media(tweet.media[file.remote_order], thumbnail=need_thumb, file=need_file)
-                    self.core.import_file(file, orig=orig, thumb=thumb, move=True)
+                    self.log.info('downloading files for post: %s, order: %r', remote_post.original_id, file.remote_order)
+                    thumb_url, orig_url = self._media_urls(tweet.media[file.remote_order], thumbnail=need_thumb, file=need_file)
+                    downloads.append((file, orig_url, thumb_url))
+            
+            self._queue_downloads(downloads)
         
         return remote_post
     
-    def download(self, url=None, remote_post=None, preview=False):
+    def download(self, url=None, remote_post=None, preview=False, refresh=False):
         """
         Creates or updates a RemotePost entry along with all the associated Files,
         and downloads all files and thumbnails that aren't present yet.
@@ -514,6 +987,9 @@ class Twitter:
         
         If preview is set to True, then only the thumbnails are downloaded.
         
+        Unless refresh is set to True, a post that already has every file
+        present is returned right away without making any request.
+        
         Returns the downloaded RemotePost object.
         """
         
@@ -526,20 +1002,79 @@ class Twitter:
             
         else:
             self.log.info('download request for %s', url)
-            if url.isdigit():
-                tweet_id = url
-                
-            else:
-                match = TWEET_REGEXP.match(url)
-                if not match:
-                    raise ValueError('unsupported url: {}'.format(repr(url)))
-                
-                tweet_id = match.group('tweet_id')
+            tweet_id = self._tweet_id(url)
+        
+        if not refresh:
+            existing = remote_post if remote_post is not None else self._get_remote_posts([tweet_id]).get(tweet_id)
+            if existing is not None and self._is_complete(existing, preview):
+                self.log.info('tweet %s is already complete', tweet_id)
+                return existing
         
-        tweet = self.api.GetStatus(tweet_id)
+        tweet = self._api_call(STATUS_ENDPOINT, self.api.GetStatus, tweet_id)
         self.log.debug('tweet: %s', tweet)
         
-        return self.tweet_to_remote_post(tweet, remote_post=remote_post, preview=preview)
+        remote_post = self.tweet_to_remote_post(tweet, remote_post=remote_post, preview=preview)
+        self._write_pending()
+        self.resolve_related(wait=True)
+        
+        return remote_post
+    
+    def _tweet_id(self, url):
+        if url.isdigit():
+            return url
+        
+        match = TWEET_REGEXP.match(url)
+        if not match:
+            raise ValueError('unsupported url: {}'.format(repr(url)))
+        
+        return match.group('tweet_id')
+    
+    def download_many(self, urls, preview=False, refresh=False):
+        """
+        Same as `download` for many urls at once, but the tweets are looked up
+        `STATUS_LOOKUP_LIMIT` at a time instead of with one request each.
+        
+        Tweets that already have every file present aren't looked up
+        unless refresh is set to True.
+        
+        Returns a dict of tweet id -> RemotePost, tweets that were deleted
+        or can't be seen are left out.
+        """
+        
+        tweet_ids = list(dict.fromkeys(self._tweet_id(url) for url in urls))
+        self.log.info('download request for %d tweets', len(tweet_ids))
+        
+        remote_posts = {}
+        if not refresh:
+            for tweet_id, existing in self._get_remote_posts(tweet_ids).items():
+                if self._is_complete(existing, preview):
+                    remote_posts[tweet_id] = existing
+            
+            tweet_ids = [tweet_id for tweet_id in tweet_ids if tweet_id not in remote_posts]
+            self.log.info('%d tweets are already complete', len(remote_posts))
+        
+        for i in range(0, len(tweet_ids), STATUS_LOOKUP_LIMIT):
+            batch = tweet_ids[i:i + STATUS_LOOKUP_LIMIT]
+            tweets = self._api_call(STATUS_LOOKUP_ENDPOINT, self.api.GetStatuses, batch)
+            
+            # look up every post of the batch at once
+            known_posts = self._get_remote_posts([
+                (tweet.retweeted_status if tweet.retweeted_status is not None else tweet).id_str
+                for tweet in tweets
+            ])
+            
+            for tweet in tweets:
+                self.log.debug('tweet: %s', tweet)
+                remote_posts[tweet.id_str] = self.tweet_to_remote_post(tweet, preview=preview, known_posts=known_posts)
+            
+            self._write_pending(commit=True)
+        
+        self.resolve_related(wait=True)
+        
+        return remote_posts
+    
+    def _is_complete(self, remote_post, preview=False):
+        return all(file.thumb_present and (preview or file.present) for file in remote_post.files)
     
     def search_form(self):
         return Form('{} search'.format(self.name),